@@ -0,0 +1,227 @@
+"""
+Latency of every route in setup_routes and of connecting a websocket, run against a database filled by seed.py, eg.
+
+    python bench/seed.py
+    python bench/api.py --save-baseline api_baseline.json
+    # make changes
+    python bench/api.py --baseline api_baseline.json
+
+The web app runs in an aiohttp test server, each case is requested --requests times one after another and
+p50/p95/p99 and the number of queries per request are reported. With --baseline, cases where p95 has grown by
+more than --tolerance or which make more queries than before are listed and the exit code is 1.
+
+Unlike the other benchmarks the database is NOT wiped, it's expected to have been seeded already.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import warnings
+from collections import Counter
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from common import BENCH_DB, format_summary, session_cookie, summarise  # NOQA
+
+from aiohttp.test_utils import TestClient, TestServer  # NOQA
+from app.main import create_app  # NOQA
+from app.settings import Settings  # NOQA
+
+logger = logging.getLogger('mithra.bench.api')
+# methods of pools and connections which each run one query
+QUERY_METHODS = {
+    'execute', 'executemany', 'fetch', 'fetchval', 'fetchrow', 'cursor', 'copy_from_query', 'copy_records_to_table',
+}
+# routes which aren't benchmarked: sign-in needs a token from google and sign-out would end the session
+SKIP_ROUTES = {'signin', 'signout'}
+
+sample_sql = """
+SELECT
+  (SELECT max(id) FROM calls) AS call,
+  (SELECT person FROM calls WHERE person IS NOT NULL ORDER BY ts DESC LIMIT 1) AS person,
+  (SELECT company FROM people GROUP BY company ORDER BY count(*) DESC LIMIT 1) AS company,
+  (SELECT number FROM people_numbers LIMIT 1) AS number
+"""
+
+
+class _Counting:
+    """
+    Proxy for an asyncpg pool or connection which counts queries.
+    """
+    def __init__(self, obj, counts):
+        self._obj = obj
+        self._counts = counts
+
+    def __getattr__(self, name):
+        if name in QUERY_METHODS:
+            self._counts['queries'] += 1
+        return getattr(self._obj, name)
+
+
+class _CountingAcquire:
+    def __init__(self, ctx, counts):
+        self._ctx = ctx
+        self._counts = counts
+
+    async def __aenter__(self):
+        return _Counting(await self._ctx.__aenter__(), self._counts)
+
+    async def __aexit__(self, *exc):
+        return await self._ctx.__aexit__(*exc)
+
+
+class CountingPool(_Counting):
+    def acquire(self, **kwargs):
+        return _CountingAcquire(self._obj.acquire(**kwargs), self._counts)
+
+
+def cases(ids):
+    """
+    route name -> list of (label, url parameters, query), routes with no parameters don't need to be listed.
+    """
+    week_ago = (datetime.utcnow() - timedelta(days=7)).strftime('%Y-%m-%d')
+    company = str(ids['company'])
+    return {
+        'call-details': [('', {'id': str(ids['call'])}, {})],
+        'person-details': [('', {'id': str(ids['person'])}, {})],
+        'company-details': [('largest', {'id': company}, {})],
+        'search': [
+            ('name', {}, {'q': 'Olivia Smith'}),
+            ('number', {}, {'q': ids['number'][:-3]}),
+            ('company', {}, {'q': 'Maths Tutors'}),
+        ],
+        'call-stats': [
+            ('day', {}, {}),
+            ('hour by company', {}, {'period': 'hour', 'by': 'company'}),
+            ('month by country', {}, {'period': 'month', 'by': 'country'}),
+        ],
+        'export': [
+            ('calls, week, company', {'kind': 'calls'}, {'from': week_ago, 'company': company}),
+            ('people, company', {'kind': 'people'}, {'company': company}),
+            ('companies csv', {'kind': 'companies'}, {'format': 'csv'}),
+        ],
+    }
+
+
+async def time_requests(client, counts, url, requests, warmup):
+    times = []
+    queries = counts['queries']
+    for i in range(warmup + requests):
+        if i == warmup:
+            queries = counts['queries']
+        start = perf_counter()
+        r = await client.get(url)
+        await r.read()
+        if i >= warmup:
+            times.append(perf_counter() - start)
+        assert r.status == 200, f'{url}: {r.status} {await r.text()}'
+    return times, (counts['queries'] - queries) / requests
+
+
+async def time_websocket(client, counts, url, requests, warmup):
+    times = []
+    queries = counts['queries']
+    for i in range(warmup + requests):
+        if i == warmup:
+            queries = counts['queries']
+        start = perf_counter()
+        ws = await client.ws_connect(url)
+        msg = await ws.receive()
+        if i >= warmup:
+            times.append(perf_counter() - start)
+        await ws.close()
+        assert isinstance(json.loads(msg.data), (list, dict)), msg
+    return times, (counts['queries'] - queries) / requests
+
+
+def compare_baseline(results, path, tolerance):
+    """
+    Print how results compare with the baseline saved at path, exits with code 1 if any case has regressed.
+    """
+    with open(path) as f:
+        baseline = json.load(f)
+    regressions = []
+    print('=' * 100)
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            print(f'{name:>28}: not in baseline')
+            continue
+        change = r['p95'] / base['p95'] - 1
+        status = '✓'
+        if change > tolerance or r['queries'] > base['queries']:
+            status = '✗ regression'
+            regressions.append(name)
+        print(f'{name:>28}: p95 {base["p95"]:8.2f}ms -> {r["p95"]:8.2f}ms ({change:+6.1%}), '
+              f'queries {base["queries"]:0.1f} -> {r["queries"]:0.1f} {status}')
+    if regressions:
+        print('regressions:', ', '.join(regressions))
+        sys.exit(1)
+
+
+async def run(args):
+    loop = asyncio.get_event_loop()
+    settings = Settings(pg_name=args.pg_name, intercom_key=None, cache_dir=args.cache_dir)
+    app = create_app(settings=settings)
+    client = TestClient(TestServer(app), loop=loop)
+    await client.start_server()
+    client.session.cookie_jar.update_cookies({'mithra': session_cookie(settings)})
+
+    counts = Counter()
+    with warnings.catch_warnings():
+        # changing a started app is deprecated, it's fine here as nothing else has a reference to the pool yet
+        warnings.simplefilter('ignore', DeprecationWarning)
+        app['pg'] = CountingPool(app['pg'], counts)
+
+    results = {}
+
+    def record(name, times, queries):
+        results[name] = dict(summarise(times), queries=queries)
+        print(f'{format_summary(name, times)} queries={queries:0.1f}')
+
+    try:
+        ids = await app['pg'].fetchrow(sample_sql)
+        assert ids['call'], 'no calls found, run seed.py first'
+        route_cases = cases(ids)
+        for route in app.router.routes():
+            if route.method != 'GET' or route.name in SKIP_ROUTES:
+                continue
+            elif route.name == 'ws':
+                url = route.url_for()
+                resume_url = url.with_query(last_id=max(ids['call'] - 50, 1))
+                record('ws', *await time_websocket(client, counts, url, args.requests, args.warmup))
+                record('ws resume', *await time_websocket(client, counts, resume_url, args.requests, args.warmup))
+                continue
+
+            for label, params, query in route_cases.get(route.name, [('', {}, {})]):
+                url = route.url_for(**params).with_query(query)
+                name = f'{route.name} {label}'.strip()
+                record(name, *await time_requests(client, counts, url, args.requests, args.warmup))
+    finally:
+        await client.close()
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'baseline saved to {args.save_baseline}')
+
+    if args.baseline:
+        compare_baseline(results, args.baseline, args.tolerance)
+
+
+def parser():
+    p = argparse.ArgumentParser(description='latency of each web route against a seeded database')
+    p.add_argument('--pg-name', default=BENCH_DB, help='database seeded with seed.py')
+    p.add_argument('--cache-dir', default='/tmp/mithra_bench')
+    p.add_argument('--requests', type=int, default=50, help='requests per case')
+    p.add_argument('--warmup', type=int, default=3, help='requests per case before timing starts')
+    p.add_argument('--baseline', help='JSON file of results to compare with')
+    p.add_argument('--save-baseline', help='JSON file to save results to')
+    p.add_argument('--tolerance', type=float, default=0.2, help='allowed growth in p95 before a case is a regression')
+    return p
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.get_event_loop().run_until_complete(run(parser().parse_args()))
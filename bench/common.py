@@ -0,0 +1,73 @@
+"""
+Helpers shared by the benchmark and load testing scripts in this directory.
+
+Scripts are run directly, eg. "python bench/sip_load.py", so importing this module also sets up sys.path
+so both the backend ("main") and web ("app") code can be imported from the source tree.
+"""
+import base64
+import json
+import math
+import sys
+from pathlib import Path
+from time import time
+
+THIS_DIR = Path(__file__).parent
+SRC_DIR = THIS_DIR.parent / 'src'
+
+for p in (SRC_DIR, SRC_DIR / 'backend', SRC_DIR / 'web'):
+    if str(p) not in sys.path:
+        sys.path.append(str(p))
+
+# database used by benchmarks unless otherwise specified, it's wiped on every run so must not be "mithra"
+BENCH_DB = 'mithra_bench'
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of values, p between 0 and 100.
+    """
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    k = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[k]
+
+
+def summarise(values, scale=1000):
+    """
+    Summary of timings in seconds, returned in milliseconds by default.
+    """
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50) * scale,
+        'p95': percentile(values, 95) * scale,
+        'p99': percentile(values, 99) * scale,
+        'max': max(values) * scale if values else float('nan'),
+    }
+
+
+def format_summary(name, values, unit='ms', scale=1000):
+    s = summarise(values, scale)
+    return (
+        f'{name:>28}: n={s["count"]:<6d} p50={s["p50"]:8.2f}{unit} p95={s["p95"]:8.2f}{unit} '
+        f'p99={s["p99"]:8.2f}{unit} max={s["max"]:8.2f}{unit}'
+    )
+
+
+def session_cookie(settings, *, email='bench@tutorcruncher.com'):
+    """
+    Build a valid "mithra" session cookie so benchmarks can use authenticated views without google sign-in.
+    """
+    from cryptography.fernet import Fernet
+
+    secret_key = base64.urlsafe_b64decode(settings.auth_key)
+    fernet = Fernet(base64.urlsafe_b64encode(secret_key))
+    now = int(time())
+    data = {
+        'created': now,
+        'session': {
+            'expires': now + 3600,
+            'user': {'email': email, 'first_name': 'bench', 'last_name': 'mark'},
+        },
+    }
+    return fernet.encrypt(json.dumps(data).encode()).decode()
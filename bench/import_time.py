@@ -0,0 +1,84 @@
+"""
+Measure the import cost of each command in src/web/run.py and compare it with a budget, eg.
+
+    python bench/import_time.py
+
+Each command's modules (as registered with @command) are imported in a fresh interpreter several times, the median
+wall time beyond a bare interpreter's startup is reported. Exits with code 1 if any command is over budget.
+"""
+import argparse
+import importlib.util
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from time import perf_counter
+
+# paths are worked out here rather than imported from common so tests can load this module without changing sys.path
+SRC_DIR = Path(__file__).resolve().parent.parent / 'src'
+WEB_DIR = SRC_DIR / 'web'
+# milliseconds of import time allowed beyond interpreter startup
+BUDGETS = {
+    'check': 25,
+    'patch': 400,
+    'reset_database': 400,
+    'download_from_intercom': 500,
+    'web': 700,
+}
+
+
+def load_web_run():
+    # loaded from its path since "run" is also the name of the backend's run.py
+    spec = importlib.util.spec_from_file_location('web_run', str(WEB_DIR / 'run.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def time_code(code, repeat):
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, cwd=str(WEB_DIR))
+        times.append(perf_counter() - start)
+    return statistics.median(times)
+
+
+def command_import_time(cmd, startup, repeat):
+    """
+    Median milliseconds to import run.py and the command's modules beyond "startup", the time to run "pass".
+    """
+    code = (
+        f'import sys; sys.path[:0] = [{str(WEB_DIR)!r}, {str(SRC_DIR)!r}]\n'
+        f'import importlib, run\n'
+        f'for m in {cmd.modules!r}: importlib.import_module(m)'
+    )
+    return (time_code(code, repeat) - startup) * 1000
+
+
+def main(args):
+    web_run = load_web_run()
+    baseline = time_code('pass', args.repeat)
+    print(f'interpreter startup: {baseline * 1000:0.1f}ms')
+    over_budget = []
+    for name, cmd in web_run.commands.items():
+        import_time = command_import_time(cmd, baseline, args.repeat)
+        budget = BUDGETS.get(name)
+        status = '✓' if budget is None or import_time <= budget else '✗ over budget'
+        if status != '✓':
+            over_budget.append(name)
+        print(f'{name:>24}: {import_time:7.1f}ms (budget {budget}ms) {status}')
+
+    if over_budget:
+        print('commands over budget:', ', '.join(over_budget))
+        sys.exit(1)
+
+
+def parser():
+    p = argparse.ArgumentParser(description='measure the import time of each web command')
+    p.add_argument('--repeat', type=int, default=5)
+    return p
+
+
+if __name__ == '__main__':
+    main(parser().parse_args())
@@ -0,0 +1,111 @@
+"""
+Benchmark a full Downloader.download() against the local intercom stand-in (intercom_server.py, run in a
+subprocess so it doesn't affect memory usage) and a local postgres, eg.
+
+    python bench/intercom_download.py --users 100000
+
+Reports wall time, time spent waiting for intercom requests, time spent waiting for the database and peak RSS.
+The database named by --pg-name (default "mithra_bench") is wiped at the start of every run.
+"""
+import argparse
+import asyncio
+import logging
+import resource
+import socket
+import subprocess
+import sys
+from time import time
+
+from common import BENCH_DB, THIS_DIR  # NOQA
+
+import asyncpg  # NOQA
+from shared.db import prepare_database  # NOQA
+from app.background import Downloader  # NOQA
+from app.settings import Settings  # NOQA
+
+logger = logging.getLogger('mithra.bench.intercom_download')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_port(port, timeout=10):
+    start = time()
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            if time() - start > timeout:
+                raise
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return
+
+
+async def run(args):
+    port = free_port()
+    server = subprocess.Popen([
+        sys.executable, str(THIS_DIR / 'intercom_server.py'),
+        '--port', str(port),
+        '--users', str(args.users),
+        '--seed', str(args.seed),
+        '--duplicates', str(args.duplicates),
+        '--missing-phones', str(args.missing_phones),
+        '--rate-limit', str(args.rate_limit),
+    ])
+    try:
+        settings = Settings(
+            pg_name=args.pg_name,
+            intercom_key='bench',
+            intercom_url=f'http://127.0.0.1:{port}',
+            cache_dir=args.cache_dir,
+        )
+        await prepare_database(settings, True)
+        await wait_for_port(port)
+
+        pg = await asyncpg.create_pool(dsn=settings.pg_dsn, min_size=1)
+        downloader = Downloader({'settings': settings, 'pg': pg}, start=False)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time()
+        await downloader.download(force=True)
+        wall_time = time() - start
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        async with pg.acquire() as conn:
+            companies = await conn.fetchval('SELECT count(*) FROM companies')
+            people = await conn.fetchval('SELECT count(*) FROM people')
+            numbers = await conn.fetchval('SELECT count(*) FROM people_numbers')
+        await pg.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    other_time = wall_time - downloader.request_time - downloader.db_time
+    print('=' * 80)
+    print(f'users: {args.users}, companies: {companies}, people: {people}, people_numbers: {numbers}')
+    print(f'wall time:    {wall_time:8.2f}s ({args.users / wall_time:0.0f} users/s)')
+    print(f'request time: {downloader.request_time:8.2f}s')
+    print(f'db time:      {downloader.db_time:8.2f}s')
+    print(f'other time:   {other_time:8.2f}s')
+    # ru_maxrss is in kilobytes on linux
+    print(f'peak RSS:     {rss_after / 1024:8.1f}MB ({(rss_after - rss_before) / 1024:0.1f}MB during download)')
+
+
+def parser():
+    p = argparse.ArgumentParser(description='benchmark Downloader.download against a local intercom stand-in')
+    p.add_argument('--users', type=int, default=10000, help='eg. 10000, 100000 or 1000000')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--duplicates', type=float, default=0.05)
+    p.add_argument('--missing-phones', type=float, default=0.1)
+    p.add_argument('--rate-limit', type=float, default=0.001, help='proportion of requests getting a 429 response')
+    p.add_argument('--pg-name', default=BENCH_DB, help='database to use, it will be wiped!')
+    p.add_argument('--cache-dir', default='/tmp/mithra_bench')
+    return p
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.get_event_loop().run_until_complete(run(parser().parse_args()))
@@ -0,0 +1,172 @@
+"""
+Local stand-in for the parts of the intercom API used by Downloader: the paginated "/companies" and "/users"
+endpoints.
+
+Datasets are generated on the fly from a seed so they're reproducible and don't need to fit in memory, eg.
+
+    python bench/intercom_server.py --users 100000 --port 8090
+
+then run a download with APP_INTERCOM_URL=http://127.0.0.1:8090 APP_INTERCOM_KEY=anything.
+"""
+import argparse
+import logging
+import random
+from collections import Counter
+
+from aiohttp import web
+
+logger = logging.getLogger('mithra.bench.intercom_server')
+
+FIRST_NAMES = ['Anne', 'Ben', 'Chloe', 'David', 'Emma', 'Frank', 'Grace', 'Harry', 'Isla', 'Jack', 'Kate', 'Liam']
+LAST_NAMES = ['Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson', 'Johnson', 'Davies', 'Patel', 'Wright']
+CITIES = [('London', 'United Kingdom'), ('Leeds', 'United Kingdom'), ('Sydney', 'Australia'),
+          ('Toronto', 'Canada'), ('Auckland', 'New Zealand'), ('Boston', 'United States')]
+PLANS = ['startup', 'payg', 'enterprise']
+BASE_TS = 1483228800  # 2017-01-01
+
+
+class Dataset:
+    """
+    Deterministic synthetic intercom data, every company and user is generated from its index so any page can be
+    rendered without generating the pages before it.
+    """
+    def __init__(self, *, users, companies=None, seed=1, duplicates=0.05, missing_phones=0.1):
+        self.users = users
+        self.companies = companies or max(1, users // 10)
+        self.seed = seed
+        self.duplicates = duplicates
+        self.missing_phones = missing_phones
+
+    def _random(self, kind, index):
+        return random.Random(f'{self.seed}:{kind}:{index}')
+
+    def company(self, index):
+        r = self._random('company', index)
+        name = f'{r.choice(LAST_NAMES)} {r.choice(["Tutors", "Education", "Learning", "Academy"])} {index}'
+        return {
+            'type': 'company',
+            'id': f'co{index:07d}',
+            'company_id': str(index),
+            'name': name if r.random() > 0.02 else None,
+            'created_at': BASE_TS + r.randint(0, 30000000),
+            'monthly_spend': r.randint(0, 500),
+            'session_count': r.randint(0, 1000),
+            'user_count': r.randint(1, 50),
+            'plan': {'type': 'plan', 'id': str(index % len(PLANS)), 'name': PLANS[index % len(PLANS)]},
+            'custom_attributes': {
+                'login_url': f'https://{index}.example.com/login/',
+                'support_package': 'gold' if r.random() < 0.3 else None,
+                'notes': 'Fish &amp; Chips &#39;limited&#39;',
+            },
+        }
+
+    def _user_identity(self, index):
+        r = self._random('identity', index)
+        return f'{r.choice(FIRST_NAMES)} {r.choice(LAST_NAMES)}', r.randrange(self.companies)
+
+    def user(self, index):
+        r = self._random('user', index)
+        if index and r.random() < self.duplicates:
+            # same name and company as the previous user but a different intercom id
+            name, company = self._user_identity(index - 1)
+        else:
+            name, company = self._user_identity(index)
+        city, country = r.choice(CITIES)
+        phone = None
+        if r.random() >= self.missing_phones:
+            phone = f'+44 (0) 7{r.randint(100, 999)} {r.randint(0, 999999):06d}'
+        return {
+            'type': 'user',
+            'id': f'u{index:08d}',
+            'name': name,
+            'phone': phone,
+            'last_request_at': BASE_TS + r.randint(0, 30000000),
+            'user_agent_data': 'Mozilla/5.0 (X11; Linux x86_64)',
+            'location_data': {'city_name': city, 'country_name': country},
+            'companies': {'type': 'company.list', 'companies': [{'type': 'company', 'id': f'co{company:07d}'}]},
+        }
+
+
+def paginate(request, total, item_func, key):
+    try:
+        page = max(1, int(request.query.get('page', 1)))
+        per_page = min(60, max(1, int(request.query.get('per_page', 15))))
+    except ValueError:
+        raise web.HTTPBadRequest(text='invalid page or per_page')
+    total_pages = max(1, -(-total // per_page))
+    start = (page - 1) * per_page
+    items = [item_func(i) for i in range(start, min(start + per_page, total))]
+    next_url = None
+    if page < total_pages:
+        next_url = str(request.url.with_query(page=page + 1, per_page=per_page))
+    return web.json_response({
+        'type': f'{key[:-1]}.list',
+        key: items,
+        'pages': {'type': 'pages', 'next': next_url, 'page': page, 'per_page': per_page, 'total_pages': total_pages},
+    })
+
+
+@web.middleware
+async def intercom_middleware(request, handler):
+    app = request.app
+    if not request.headers.get('Authorization', '').startswith('Bearer '):
+        return web.json_response({'type': 'error.list', 'errors': [{'code': 'unauthorized'}]}, status=401)
+    if app['rate_limit_random'].random() < app['rate_limit']:
+        app['counts']['429'] += 1
+        return web.json_response({'type': 'error.list', 'errors': [{'code': 'rate_limit_exceeded'}]}, status=429)
+    app['counts'][request.path] += 1
+    return await handler(request)
+
+
+async def companies(request):
+    dataset: Dataset = request.app['dataset']
+    return paginate(request, dataset.companies, dataset.company, 'companies')
+
+
+async def users(request):
+    dataset: Dataset = request.app['dataset']
+    return paginate(request, dataset.users, dataset.user, 'users')
+
+
+async def log_counts(app):
+    logger.info('request counts: %s', dict(app['counts']))
+
+
+def create_app(*, users, seed=1, rate_limit=0.001, **dataset_kwargs):
+    app = web.Application(middlewares=(intercom_middleware,))
+    app.update(
+        dataset=Dataset(users=users, seed=seed, **dataset_kwargs),
+        rate_limit=rate_limit,
+        rate_limit_random=random.Random(seed),
+        counts=Counter(),
+    )
+    app.router.add_get('/companies', companies)
+    app.router.add_get('/users', users)
+    app.on_cleanup.append(log_counts)
+    return app
+
+
+def parser():
+    p = argparse.ArgumentParser(description='local stand-in for the intercom companies and users API')
+    p.add_argument('--port', type=int, default=8090)
+    p.add_argument('--users', type=int, default=10000)
+    p.add_argument('--companies', type=int, default=None, help='defaults to users / 10')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--duplicates', type=float, default=0.05, help='proportion of users duplicating the previous user')
+    p.add_argument('--missing-phones', type=float, default=0.1, help='proportion of users with no phone number')
+    p.add_argument('--rate-limit', type=float, default=0.001, help='proportion of requests getting a 429 response')
+    return p
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = parser().parse_args()
+    app = create_app(
+        users=args.users,
+        companies=args.companies,
+        seed=args.seed,
+        duplicates=args.duplicates,
+        missing_phones=args.missing_phones,
+        rate_limit=args.rate_limit,
+    )
+    web.run_app(app, host='127.0.0.1', port=args.port, access_log=None)
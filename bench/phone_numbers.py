@@ -0,0 +1,99 @@
+"""
+Measure the memory and per-number cost of shared.numbers, optionally compared with the phonenumbers package, eg.
+
+    python bench/phone_numbers.py --count 100000
+
+Memory is measured with tracemalloc from importing the module to having normalised the first number, so includes
+the country code table which is only built when first needed. phonenumbers is only compared if it's installed.
+"""
+import argparse
+import random
+import tracemalloc
+from time import perf_counter
+
+from common import SRC_DIR  # NOQA
+
+FORMATS = [
+    '+44 7700 {}',
+    '07700 {}',
+    '+44 (0) 7700 {}',
+    '0044 7700 {}',
+    '447700{}',
+    '+1 (415) 555-{}',
+    '+33 6 12 {}',
+    'unknown',
+]
+
+
+def sample_numbers(count, seed=123):
+    rand = random.Random(seed)
+    numbers = []
+    for _ in range(count):
+        fmt = rand.choice(FORMATS)
+        digits = f'{rand.randrange(10 ** 6):06d}'
+        numbers.append(fmt.format(digits[:4] if '555' in fmt else digits))
+    return numbers
+
+
+def measure(name, setup, normalise, numbers):
+    tracemalloc.start()
+    setup()
+    normalise(numbers[0])
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = perf_counter()
+    results = [normalise(n) for n in numbers]
+    per_number = (perf_counter() - start) / len(numbers)
+    normalised = sum(r is not None for r in results)
+    print(f'{name:>15}: memory {memory / 1024:8.1f}KB, {per_number * 1e6:6.2f}µs per number, '
+          f'{normalised}/{len(numbers)} normalised')
+    return results
+
+
+def run(args):
+    numbers = sample_numbers(args.count)
+    module = {}
+
+    def setup_shared():
+        from shared import numbers as shared_numbers
+        module['shared'] = shared_numbers
+
+    def normalise_shared(n):
+        return module['shared'].canonical_number(n, args.country_code)
+
+    shared = measure('shared.numbers', setup_shared, normalise_shared, numbers)
+
+    try:
+        import phonenumbers  # NOQA
+    except ImportError:
+        print('phonenumbers not installed, not comparing')
+        return
+
+    region = phonenumbers.region_code_for_country_code(int(args.country_code))
+
+    def normalise_phonenumbers(n):
+        try:
+            p = phonenumbers.parse(n, region)
+        except phonenumbers.NumberParseException:
+            return None
+        return phonenumbers.format_number(p, phonenumbers.PhoneNumberFormat.E164)
+
+    # phonenumbers loads its metadata lazily too, so importing it above barely counts towards memory
+    theirs = measure('phonenumbers', lambda: None, normalise_phonenumbers, numbers)
+    differences = [(n, a, b) for n, a, b in zip(numbers, shared, theirs) if a != b]
+    print(f'{len(differences)} differences')
+    for n, a, b in differences[:args.show]:
+        print(f'  {n!r:>22}: {a!r:>18} != {b!r}')
+
+
+def parser():
+    p = argparse.ArgumentParser(description='phone number normalisation memory and speed')
+    p.add_argument('--count', type=int, default=50000, help='numbers to normalise')
+    p.add_argument('--country-code', default='44', help='default country code for national numbers')
+    p.add_argument('--show', type=int, default=10, help='differences with phonenumbers to show')
+    return p
+
+
+if __name__ == '__main__':
+    run(parser().parse_args())
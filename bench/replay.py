@@ -0,0 +1,124 @@
+"""
+Replay a datagram capture (see DatagramCapture in the backend, enabled with APP_CAPTURE_DATAGRAMS=1) through
+SipClient and report per-message parse and dispatch timings, eg.
+
+    python bench/replay.py /persistent/datagrams.cap --fast
+
+By default INVITEs are counted but not recorded, use --db to record them in a local database
+(default "mithra_bench" which is wiped first) so the database write path is included.
+"""
+import argparse
+import asyncio
+import logging
+from collections import Counter, defaultdict
+from time import perf_counter, time
+
+from common import BENCH_DB, format_summary  # NOQA
+
+from main import Database, Settings, SipClient, parse_datagram, read_capture  # NOQA
+from shared.db import prepare_database  # NOQA
+
+logger = logging.getLogger('mithra.bench.replay')
+
+
+class CountingDatabase:
+    """
+    Stands in for Database when calls shouldn't be recorded.
+    """
+    def __init__(self):
+        self.calls = Counter()
+
+    def record_call(self, number, country, trace=None):
+        self.calls[country] += 1
+
+    async def complete_tasks(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+def message_kind(status):
+    return status.get('method') or f'response {status["status_code"]}'
+
+
+async def replay(args):
+    loop = asyncio.get_event_loop()
+    settings = Settings(
+        pg_name=args.pg_name,
+        sip_host='127.0.0.1',
+        sip_username='replay',
+        sip_password='replay',
+        cache_dir=args.cache_dir,
+    )
+    if args.db:
+        await prepare_database(settings, True)
+        db = Database(settings, loop)
+        await db.init()
+    else:
+        db = CountingDatabase()
+    client = SipClient(settings, db, loop)
+
+    parse_times, dispatch_times = defaultdict(list), defaultdict(list)
+    counts = Counter()
+    first_ts, replay_start = None, time()
+    for ts, raw_data in read_capture(args.capture):
+        if first_ts is None:
+            first_ts = ts
+        if not args.fast:
+            await asyncio.sleep(max(0, (ts - first_ts) / args.speed - (time() - replay_start)))
+        if raw_data.startswith(b'\x00'):
+            counts['ping'] += 1
+            continue
+
+        try:
+            start = perf_counter()
+            status, headers, data = parse_datagram(raw_data)
+            parsed = perf_counter()
+            kind = message_kind(status)
+            if 'status_code' in status:
+                # responses would otherwise be logged as having no request future
+                client.request_future = loop.create_future()
+            client.dispatch(status, headers, data)
+            dispatched = perf_counter()
+        except Exception as e:
+            counts[f'error {e.__class__.__name__}'] += 1
+            continue
+        finally:
+            client.request_future = None
+        counts[kind] += 1
+        parse_times[kind].append(parsed - start)
+        dispatch_times[kind].append(dispatched - parsed)
+
+    replay_time = time() - replay_start
+    start = time()
+    await db.complete_tasks()
+    db_time = time() - start
+    await db.close()
+
+    total = sum(counts.values())
+    print('=' * 100)
+    print(f'replayed {total} datagrams in {replay_time:0.3f}s ({total / replay_time:0.0f}/s), '
+          f'database drain {db_time:0.3f}s')
+    print('counts:', dict(counts))
+    if isinstance(db, CountingDatabase):
+        print('calls recorded by country:', dict(db.calls))
+    for kind in sorted(parse_times):
+        print(format_summary(f'{kind} parse', parse_times[kind], 'µs', 1e6))
+        print(format_summary(f'{kind} dispatch', dispatch_times[kind], 'µs', 1e6))
+
+
+def parser():
+    p = argparse.ArgumentParser(description='replay a datagram capture through SipClient')
+    p.add_argument('capture', help='capture file written by the backend')
+    p.add_argument('--fast', action='store_true', help='replay as fast as possible rather than at recorded speed')
+    p.add_argument('--speed', type=float, default=1, help='speed multiplier when not using --fast')
+    p.add_argument('--db', action='store_true', help='record calls in the database')
+    p.add_argument('--pg-name', default=BENCH_DB, help='database to use with --db, it will be wiped!')
+    p.add_argument('--cache-dir', default='/tmp/mithra_replay')
+    return p
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.get_event_loop().run_until_complete(replay(parser().parse_args()))
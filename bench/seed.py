@@ -0,0 +1,142 @@
+"""
+Fill a local postgres with realistic volumes of companies, people, numbers and calls for api.py, eg.
+
+    python bench/seed.py --companies 50000 --people 500000 --calls 2000000
+
+Rows are generated in batches and written with COPY so memory use doesn't grow with the volumes. Calls are spread
+over the last --months months (partitions are created as needed), --matched of them are from a person's number.
+Call stats are rebuilt at the end so the stats views have data. The database named by --pg-name
+(default "mithra_bench") is wiped first.
+"""
+import argparse
+import asyncio
+import json
+import random
+from datetime import datetime, timedelta
+from time import time
+
+from common import BENCH_DB  # NOQA
+
+import asyncpg  # NOQA
+from shared.db import prepare_database  # NOQA
+from app.background import update_call_stats  # NOQA
+from app.settings import Settings  # NOQA
+
+BATCH = 10000
+FIRST_NAMES = 'Anna Ben Chloe Dan Ella Finn Grace Harry Isla Jack Kate Leo Mia Noah Olivia Sam Tom Zoe'.split()
+LAST_NAMES = 'Smith Jones Taylor Brown Williams Wilson Johnson Davies Patel Wright Green Hall Wood Khan'.split()
+COMPANY_WORDS = 'Maths English Science Music Tutors Academy Learning Education Centre Hub Scholars Bright'.split()
+CITIES = 'London Manchester Bristol Leeds Glasgow Cardiff Dublin Paris Sydney Toronto'.split()
+COUNTRIES = ['GB'] * 8 + ['IE', 'FR', 'AU', 'CA', 'US', None]
+
+
+def person_number(person_id):
+    # one UK mobile number per person, calls from a person use it so they're matched exactly like real calls
+    return f'+4475{person_id:08d}'
+
+
+def batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def companies(rand, count, now):
+    for i in range(count):
+        name = f'{rand.choice(COMPANY_WORDS)} {rand.choice(COMPANY_WORDS)} {i}'
+        details = {'city': rand.choice(CITIES)}
+        created = now - timedelta(days=rand.randrange(3 * 365))
+        yield name, f'co-{i}', created, f'https://{i}.example.com/login', rand.random() < 0.3, json.dumps(details)
+
+
+def people(rand, count, first_company, companies_count, now):
+    for i in range(count):
+        if rand.random() < 0.5:
+            # half the people are in a few large companies so company_people_sql has big companies to work with
+            company = first_company + min(int(rand.paretovariate(1.2)) - 1, companies_count - 1)
+        else:
+            company = first_company + rand.randrange(companies_count)
+        details = {'city': rand.choice(CITIES), 'country': rand.choice(COUNTRIES)}
+        last_seen = now - timedelta(seconds=rand.randrange(365 * 24 * 3600))
+        name = f'{rand.choice(FIRST_NAMES)} {rand.choice(LAST_NAMES)}'
+        yield company, name, f'p-{i}', last_seen, json.dumps(details)
+
+
+def calls(rand, count, first_person, people_count, start, now, matched):
+    seconds = int((now - start).total_seconds())
+    for _ in range(count):
+        ts = start + timedelta(seconds=rand.randrange(seconds))
+        if rand.random() < matched:
+            person = first_person + rand.randrange(people_count)
+            yield person_number(person), person, rand.choice(COUNTRIES), ts
+        else:
+            yield f'+4420{rand.randrange(10 ** 8):08d}', None, rand.choice(COUNTRIES), ts
+
+
+async def copy(conn, table, columns, rows):
+    start, count = time(), 0
+    for batch in batches(rows):
+        await conn.copy_records_to_table(table, records=batch, columns=columns)
+        count += len(batch)
+    print(f'{table:>15}: {count:9d} rows in {time() - start:6.1f}s')
+    return count
+
+
+async def run(args):
+    settings = Settings(pg_name=args.pg_name, intercom_key=None)
+    await prepare_database(settings, True)
+    rand = random.Random(args.seed)
+    now = datetime.utcnow()
+    start = now - timedelta(days=30 * args.months)
+
+    conn = await asyncpg.connect(dsn=settings.pg_dsn)
+    try:
+        first_company = await conn.fetchval("SELECT nextval('companies_id_seq')") + 1
+        await copy(conn, 'companies', ['name', 'ic_id', 'created', 'login_url', 'has_support', 'details'],
+                   companies(rand, args.companies, now))
+
+        # people_search trigger fills "search" for each person so it's left enabled
+        first_person = await conn.fetchval("SELECT nextval('people_id_seq')") + 1
+        await copy(conn, 'people', ['company', 'name', 'ic_id', 'last_seen', 'details'],
+                   people(rand, args.people, first_company, args.companies, now))
+        await copy(conn, 'people_numbers', ['person', 'number'],
+                   ((p, person_number(p)) for p in range(first_person, first_person + args.people)))
+
+        await conn.execute("""
+        SELECT create_calls_partition(month)
+        FROM generate_series(date_trunc('month', $1::TIMESTAMP), $2::TIMESTAMP, '1 month') AS month
+        """, start, now)
+        async with conn.transaction():
+            # calls are matched by the generator, so fill_call and call_notify aren't needed
+            await conn.execute("SET LOCAL mithra.importing = 'on'")
+            await copy(conn, 'calls', ['number', 'person', 'country', 'ts'],
+                       calls(rand, args.calls, first_person, args.people, start, now, args.matched))
+
+        stats_start = time()
+        async with conn.transaction():
+            await update_call_stats(conn, lag=0, rebuild=True)
+        print(f'call stats rebuilt in {time() - stats_start:0.1f}s')
+        await conn.execute('ANALYZE')
+    finally:
+        await conn.close()
+
+
+def parser():
+    p = argparse.ArgumentParser(description='seed a local database with a large dataset')
+    p.add_argument('--pg-name', default=BENCH_DB, help='database to use, it will be wiped!')
+    p.add_argument('--companies', type=int, default=50000)
+    p.add_argument('--people', type=int, default=500000)
+    p.add_argument('--calls', type=int, default=2000000)
+    p.add_argument('--months', type=int, default=6, help='months of calls')
+    p.add_argument('--matched', type=float, default=0.7, help='proportion of calls from a known person')
+    p.add_argument('--seed', type=int, default=123)
+    return p
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(run(parser().parse_args()))
@@ -0,0 +1,136 @@
+"""
+End-to-end load test of the call hot path against a local postgres:
+
+    INVITE sent by the local registrar -> "calls" row committed (seen via LISTEN) -> WebSocket frame received
+
+Runs the real backend (Database and SipClient) and the real web app (in an aiohttp test server) in one process,
+then reports latency percentiles for each hop and overall throughput, eg.
+
+    python bench/sip_load.py --calls 2000 --rate 100
+
+The database named by --pg-name (default "mithra_bench") is wiped at the start of every run.
+"""
+import argparse
+import asyncio
+import json
+import logging
+from time import time
+
+from common import BENCH_DB, format_summary, session_cookie  # NOQA
+from sip_server import start_registrar  # NOQA
+
+import asyncpg  # NOQA
+from aiohttp.test_utils import TestClient, TestServer  # NOQA
+from main import Database, SipClient  # NOQA
+from main import Settings as BackendSettings  # NOQA
+from shared.db import prepare_database  # NOQA
+from shared.numbers import call_number  # NOQA
+from app.main import create_app  # NOQA
+from app.settings import Settings as WebSettings  # NOQA
+
+logger = logging.getLogger('mithra.bench.sip_load')
+
+
+async def run(args):
+    loop = asyncio.get_event_loop()
+    web_settings = WebSettings(pg_name=args.pg_name, intercom_key=None, cache_dir=args.cache_dir)
+    await prepare_database(web_settings, True)
+
+    sip_transport, registrar = await start_registrar(username='bench', password='testing', max_expires=args.expires)
+    _, sip_port = sip_transport.get_extra_info('sockname')
+
+    web_client = TestClient(TestServer(create_app(settings=web_settings)), loop=loop)
+    backend_settings = BackendSettings(
+        pg_name=args.pg_name,
+        sip_host='127.0.0.1',
+        sip_port=sip_port,
+        sip_username='bench',
+        sip_password='testing',
+        cache_dir=args.cache_dir,
+        register_expires=args.expires,
+        health_port=0,
+    )
+    db = Database(backend_settings, loop)
+    # the schema is ready once prepare_database has run so the web app and the backend can start together
+    await asyncio.gather(web_client.start_server(), db.init())
+    web_client.session.cookie_jar.update_cookies({'mithra': session_cookie(web_settings)})
+    sip_client = SipClient(backend_settings, db, loop)
+    await sip_client.start()
+
+    notified, ws_received = {}, {}
+    all_received = asyncio.Event()
+
+    def on_notify(conn, pid, channel, payload):
+        notified.setdefault(json.loads(payload)['number'], loop.time())
+
+    listen_conn = await asyncpg.connect(dsn=web_settings.pg_dsn)
+    await listen_conn.add_listener('call', on_notify)
+
+    ws = await web_client.ws_connect('/api/ws/')
+    snapshot = await ws.receive_json()
+    assert isinstance(snapshot, list), snapshot
+
+    async def read_ws():
+        async for msg in ws:
+            data = json.loads(msg.data)
+            if isinstance(data, dict):
+                ws_received.setdefault(data['number'], loop.time())
+                if len(ws_received) >= args.calls:
+                    all_received.set()
+
+    ws_task = loop.create_task(read_ws())
+    try:
+        await asyncio.wait_for(registrar.registered.wait(), timeout=10)
+        print(f'backend registered, sending {args.calls} INVITEs at {args.rate}/s...')
+        start = time()
+        numbers = await registrar.invite_storm(
+            calls=args.calls, rate=args.rate, retransmit=args.retransmit, options=args.options
+        )
+        send_time = time() - start
+        try:
+            await asyncio.wait_for(all_received.wait(), timeout=args.timeout)
+        except asyncio.TimeoutError:
+            print(f'timed out waiting for calls, {len(ws_received)}/{len(numbers)} received')
+        total_time = time() - start
+        await db.complete_tasks()
+        row_count = await listen_conn.fetchval('SELECT count(*) FROM calls')
+    finally:
+        sip_client.stop('finished')
+        await sip_client.run_forever()
+        ws_task.cancel()
+        await ws.close()
+        await listen_conn.close()
+        await web_client.close()
+        sip_transport.close()
+
+    # notifications and websocket frames carry numbers as the backend saves them, the registrar sends "+<number>"
+    sent = {call_number(f'+{n}'): t for n, t in registrar.invites_sent.items()}
+    numbers = [call_number(f'+{n}') for n in numbers]
+    print('=' * 100)
+    print(f'INVITEs sent: {len(numbers)} in {send_time:0.2f}s, ({len(numbers) / send_time:0.1f}/s), '
+          f'retransmissions: {registrar.counts["INVITE retransmission"]}, OPTIONS: {registrar.counts["OPTIONS"]}')
+    print(f'calls rows: {row_count}, duplicates: {row_count - len(numbers)}, '
+          f'websocket frames: {len(ws_received)} ({len(ws_received) / total_time:0.1f}/s)')
+    print(format_summary('INVITE -> row (NOTIFY)', [notified[n] - sent[n] for n in numbers if n in notified]))
+    print(format_summary('row (NOTIFY) -> ws frame', [ws_received[n] - notified[n] for n in numbers
+                                                      if n in ws_received and n in notified]))
+    print(format_summary('INVITE -> ws frame', [ws_received[n] - sent[n] for n in numbers if n in ws_received]))
+    print('registrar counts:', dict(registrar.counts))
+
+
+def parser():
+    p = argparse.ArgumentParser(description='SIP INVITE -> calls row -> websocket load test')
+    p.add_argument('--pg-name', default=BENCH_DB, help='database to use, it will be wiped!')
+    p.add_argument('--cache-dir', default='/tmp/mithra_bench')
+    p.add_argument('--calls', type=int, default=500)
+    p.add_argument('--rate', type=float, default=50, help='INVITEs per second')
+    p.add_argument('--retransmit', type=float, default=0.1, help='probability of an INVITE being retransmitted')
+    p.add_argument('--options', type=float, default=0.05, help='probability of an OPTIONS ping between INVITEs')
+    p.add_argument('--expires', type=int, default=300, help='registration expiry')
+    p.add_argument('--timeout', type=float, default=30, help='time to wait for calls after the last INVITE')
+    return p
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.get_event_loop().run_until_complete(run(parser().parse_args()))
@@ -0,0 +1,265 @@
+"""
+Local stand-in for a SIP provider: a UDP registrar which issues digest challenges and can fire INVITE storms
+at a registered client.
+
+Used by sip_load.py, it can also be run on its own to point a real backend at, eg.
+
+    python bench/sip_server.py --port 5070 --calls 500 --rate 20
+
+then run the backend with APP_SIP_HOST=127.0.0.1 APP_SIP_PORT=5070 APP_SIP_USERNAME=bench APP_SIP_PASSWORD=testing.
+"""
+import argparse
+import asyncio
+import logging
+import random
+import secrets
+from collections import Counter
+
+from common import SRC_DIR  # NOQA, sets up sys.path
+from main import md5digest, parse_headers  # NOQA
+
+logger = logging.getLogger('mithra.bench.sip_server')
+REASONS = {
+    200: 'OK',
+    401: 'Unauthorized',
+    403: 'Forbidden',
+    405: 'Method Not Allowed',
+    503: 'Service Unavailable',
+}
+
+
+def parse_auth(header):
+    """
+    Parse 'Digest username="x", realm="y", ...' into a dict.
+    """
+    _, params = header.split(' ', 1)
+    auth = {}
+    for part in params.split(','):
+        k, v = part.strip().split('=', 1)
+        auth[k] = v.strip('"')
+    return auth
+
+
+class SipRegistrar(asyncio.DatagramProtocol):
+    """
+    Minimal registrar, enough to behave like the real provider as far as SipClient is concerned:
+
+    * REGISTER without credentials gets a 401 with a digest challenge
+    * REGISTER with valid credentials gets a 200 and creates a binding for "Expires" seconds (capped at max_expires),
+      "Expires: 0" removes the binding or all bindings with "Contact: *"
+    * the first "reject_registrations" authenticated REGISTERs get a 503 with "Retry-After"
+    * INVITEs and OPTIONS pings are sent to the address of the most recent live binding
+    """
+    def __init__(self, *, username, password, realm='mithra.local', max_expires=3600, reject_registrations=0,
+                 retry_after=5, loop=None):
+        self.username = username
+        self.password = password
+        self.realm = realm
+        self.max_expires = max_expires
+        self.reject_registrations = reject_registrations
+        self.retry_after = retry_after
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.transport = None
+        self.nonce = secrets.token_hex(16)
+        # addr -> loop time the binding expires
+        self.bindings = {}
+        self.registered = asyncio.Event()
+        self.unregistered = asyncio.Event()
+        self.counts = Counter()
+        # number -> loop time the first INVITE for that number was sent
+        self.invites_sent = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.counts['received'] += 1
+        raw_headers, _ = data.split(b'\r\n\r\n', 1)
+        status, headers = parse_headers(raw_headers)
+        method = status.get('method')
+        if method == 'REGISTER':
+            self.process_register(status, headers, addr)
+        elif 'status_code' in status:
+            # client responses, SipClient doesn't currently send any
+            self.counts['responses'] += 1
+        else:
+            self.counts[f'unexpected {method}'] += 1
+            self.respond(addr, 405, headers)
+
+    def process_register(self, status, headers, addr):
+        self.counts['register'] += 1
+        auth = headers.get('Authorization')
+        if not auth:
+            self.counts['challenge'] += 1
+            self.respond(addr, 401, headers,
+                         f'WWW-Authenticate: Digest realm="{self.realm}", nonce="{self.nonce}", algorithm=MD5')
+            return
+
+        auth = parse_auth(auth)
+        ha1 = md5digest(self.username, self.realm, self.password)
+        ha2 = md5digest('REGISTER', auth['uri'])
+        if (auth['username'] != self.username or auth['nonce'] != self.nonce or
+                auth['response'] != md5digest(ha1, self.nonce, ha2)):
+            self.counts['forbidden'] += 1
+            self.respond(addr, 403, headers)
+            return
+
+        if self.counts['rejected'] < self.reject_registrations:
+            self.counts['rejected'] += 1
+            self.respond(addr, 503, headers, f'Retry-After: {self.retry_after}')
+            return
+
+        expires = min(int(headers.get('Expires', self.max_expires)), self.max_expires)
+        if expires == 0 and headers.get('Contact') == '*':
+            self.bindings.clear()
+            self.counts['cleared'] += 1
+        elif expires == 0:
+            self.bindings.pop(addr, None)
+            self.counts['unregistered'] += 1
+            self.unregistered.set()
+        else:
+            self.bindings[addr] = self.loop.time() + expires
+            self.counts['registered'] += 1
+            self.registered.set()
+        self.respond(addr, 200, headers, f'Expires: {expires}')
+
+    def respond(self, addr, status_code, req_headers, *extra_headers):
+        lines = [
+            f'SIP/2.0 {status_code} {REASONS[status_code]}',
+            *(f'{k}: {req_headers[k]}' for k in ('Via', 'From', 'To', 'Call-ID', 'CSeq') if k in req_headers),
+            *extra_headers,
+            'Content-Length: 0',
+        ]
+        self.transport.sendto(('\r\n'.join(lines) + '\r\n\r\n').encode(), addr)
+
+    def client_addr(self):
+        now = self.loop.time()
+        live = [addr for addr, expires in self.bindings.items() if expires > now]
+        return live[-1] if live else None
+
+    def send_request(self, method, *headers, body=''):
+        addr = self.client_addr()
+        if not addr:
+            self.counts[f'{method} no binding'] += 1
+            return None
+        lines = [
+            f'{method} sip:{self.username}@{addr[0]}:{addr[1]} SIP/2.0',
+            f'Via: SIP/2.0/UDP 127.0.0.1;branch=z9hG4bK{secrets.token_hex(8)};rport',
+            *headers,
+            f'Content-Length: {len(body)}',
+        ]
+        data = ('\r\n'.join(lines) + '\r\n\r\n' + body).encode()
+        self.transport.sendto(data, addr)
+        self.counts[method] += 1
+        return data
+
+    def send_options(self):
+        self.send_request(
+            'OPTIONS',
+            f'From: <sip:{self.realm}>;tag={secrets.token_hex(4)}',
+            f'To: <sip:{self.username}@{self.realm}>',
+            f'Call-ID: {secrets.token_hex(12)}@{self.realm}',
+            'CSeq: 1 OPTIONS',
+        )
+
+    def send_invite(self, number, brand=None):
+        sdp = 'v=0\r\no=- 0 0 IN IP4 127.0.0.1\r\ns=-\r\nc=IN IP4 127.0.0.1\r\nt=0 0\r\nm=audio 10000 RTP/AVP 0\r\n'
+        headers = [
+            f'From: "+{number}" <sip:+{number}@{self.realm}>;tag={secrets.token_hex(4)}',
+            f'To: <sip:{self.username}@{self.realm}>',
+            f'Call-ID: {secrets.token_hex(12)}@{self.realm}',
+            'CSeq: 1 INVITE',
+            'Content-Type: application/sdp',
+        ]
+        if brand:
+            headers.append(f'X-Brand: {brand}')
+        data = self.send_request('INVITE', *headers, body=sdp)
+        if data:
+            self.invites_sent.setdefault(number, self.loop.time())
+        return data
+
+    def retransmit(self, data):
+        addr = self.client_addr()
+        if addr:
+            self.transport.sendto(data, addr)
+            self.counts['INVITE retransmission'] += 1
+
+    async def invite_storm(self, *, calls, rate, retransmit=0.1, options=0.05, brands=('brand-a', 'brand-b', None),
+                           seed=123):
+        """
+        Send "calls" INVITEs at "rate" per second, each INVITE is retransmitted after 500ms (SIP's T1) with
+        probability "retransmit" and an OPTIONS ping is sent between INVITEs with probability "options".
+
+        :return: list of numbers called
+        """
+        rand = random.Random(seed)
+        numbers = []
+        start = self.loop.time()
+        for i in range(calls):
+            await asyncio.sleep(max(0, start + i / rate - self.loop.time()))
+            number = f'4420{i:08d}'
+            data = self.send_invite(number, rand.choice(brands))
+            if data:
+                numbers.append(number)
+                if rand.random() < retransmit:
+                    self.loop.call_later(0.5, self.retransmit, data)
+            if rand.random() < options:
+                self.send_options()
+        return numbers
+
+
+async def start_registrar(host='127.0.0.1', port=0, **kwargs):
+    loop = asyncio.get_event_loop()
+    transport, registrar = await loop.create_datagram_endpoint(
+        lambda: SipRegistrar(loop=loop, **kwargs),
+        local_addr=(host, port),
+    )
+    return transport, registrar
+
+
+async def serve(args):
+    transport, registrar = await start_registrar(
+        args.host, args.port,
+        username=args.username,
+        password=args.password,
+        max_expires=args.max_expires,
+        reject_registrations=args.reject,
+        retry_after=args.retry_after,
+    )
+    print('registrar listening on {}:{}'.format(*transport.get_extra_info('sockname')))
+    try:
+        await registrar.registered.wait()
+        print('client registered, sending INVITEs...')
+        numbers = await registrar.invite_storm(
+            calls=args.calls, rate=args.rate, retransmit=args.retransmit, options=args.options
+        )
+        print(f'sent {len(numbers)} INVITEs, waiting for un-register, ctrl+c to stop...')
+        await registrar.unregistered.wait()
+    finally:
+        transport.close()
+        print('counts:', dict(registrar.counts))
+
+
+def parser():
+    p = argparse.ArgumentParser(description='local SIP registrar and INVITE generator')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=5070)
+    p.add_argument('--username', default='bench')
+    p.add_argument('--password', default='testing')
+    p.add_argument('--max-expires', type=int, default=3600, help='cap on "Expires" granted to REGISTERs')
+    p.add_argument('--reject', type=int, default=0, help='number of REGISTERs to reject with "Retry-After"')
+    p.add_argument('--retry-after', type=int, default=5)
+    p.add_argument('--calls', type=int, default=100)
+    p.add_argument('--rate', type=float, default=10, help='INVITEs per second')
+    p.add_argument('--retransmit', type=float, default=0.1, help='probability of an INVITE being retransmitted')
+    p.add_argument('--options', type=float, default=0.05, help='probability of an OPTIONS ping between INVITEs')
+    return p
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.get_event_loop().run_until_complete(serve(parser().parse_args()))
+    except KeyboardInterrupt:
+        pass
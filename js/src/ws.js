@@ -24,6 +24,19 @@ const notify_call = async msg => {
   }
 }
 const NEW_TIME = 5000
+// same as the server's snapshot
+const MAX_CALLS = 100
+
+
+// the server only sends calls for these brands and/or from companies with support,
+// eg. localStorage.brands = 'brand-a,brand-b' and localStorage.support_only = '1'
+const subscription_args = () => {
+  const args = (localStorage.brands || '').split(',').filter(b => b).map(b => 'brand=' + encodeURIComponent(b))
+  if (localStorage.support_only === '1') {
+    args.push('support=1')
+  }
+  return args
+}
 
 
 export default function CallsWebSocket (app) {
@@ -35,7 +48,16 @@ export default function CallsWebSocket (app) {
       console.log('ws already connected')
       return
     }
+    const args = subscription_args()
+    const calls = app.state.ws_calls || []
+    if (calls.length) {
+      // resume: the server only sends calls we've missed unless there are too many
+      args.push(`last_id=${Math.max(...calls.map(c => c.id))}`)
+    }
     let ws_url = make_url('/ws/').replace('http', 'ws')
+    if (args.length) {
+      ws_url += '?' + args.join('&')
+    }
     let socket
     try {
       socket = new WebSocket(ws_url)
@@ -57,13 +79,11 @@ export default function CallsWebSocket (app) {
         app.setState({auth: false})
       } else {
         console.warn('websocket closed, reconnecting in 5 seconds', e)
-
-
         setTimeout(this.connect, 3000)
         setTimeout(() => {
-          // if we're still not connected clear the calls list
+          // calls are kept so we can resume when reconnected
           if (!this._connected) {
-            app.setState({status: 'offline', ws_calls: []})
+            app.setState({status: 'offline'})
           }
         }, 5000)
       }
@@ -80,9 +100,16 @@ export default function CallsWebSocket (app) {
     first_msg = false
     app.setState({status: 'online'})
     const data = JSON.parse(event.data)
-    const new_call = !Array.isArray(data)
+    const missed = !Array.isArray(data) && Array.isArray(data.missed)
+    const new_call = !Array.isArray(data) && !missed
     app.setState({ws_error: null})
-    update_calls(new_call ? [data].concat(app.state.ws_calls) : data)
+    if (missed) {
+      update_calls(merge_calls(data.missed, app.state.ws_calls))
+    } else if (new_call) {
+      update_calls(merge_calls([data], app.state.ws_calls))
+    } else {
+      update_calls(data)
+    }
     if (new_call) {
       let msg = ''
       if (data.person_name) {
@@ -104,6 +131,11 @@ export default function CallsWebSocket (app) {
     setTimeout(() => update_calls(), NEW_TIME + 100)
   }
 
+  const merge_calls = (new_calls, calls) => {
+    const ids = new Set(new_calls.map(c => c.id))
+    return new_calls.concat(calls.filter(c => !ids.has(c.id))).slice(0, MAX_CALLS)
+  }
+
   const update_calls = calls => {
     const now = new Date()
     calls = calls || app.state.ws_calls
@@ -1,9 +1,13 @@
 import asyncio
 import hashlib
+import json
 import logging
+import os
 import re
 import secrets
 import signal
+import socket
+import struct
 from pathlib import Path
 from time import time
 from typing import NamedTuple
@@ -11,7 +15,9 @@ from typing import NamedTuple
 import asyncpg
 from async_timeout import timeout
 
-from shared.db import lenient_conn
+from shared.db import BACKEND_LOCK, lenient_conn
+from shared.loop import LoopLagMonitor, set_loop_policy
+from shared.numbers import call_number, sip_number
 from shared.settings import PgSettings
 
 try:
@@ -29,10 +35,30 @@ class Settings(PgSettings):
     sip_username: str
     sip_password: str
     cache_dir: str = '/tmp/mithra'
-    sentinel_file: str = 'sentinel.txt'
+    # local http health/status listener, see HealthServer
+    health_host = '127.0.0.1'
+    health_port = 8001
+    # write every received datagram to capture_file in cache_dir, see DatagramCapture
+    capture_datagrams: bool = False
+    capture_file: str = 'datagrams.cap'
+    # country code of national numbers, see shared.numbers.canonical_number
+    default_country_code = '44'
+    # whether caller ids without a "+" or "0", eg. "447700900123", are international rather than national numbers
+    sip_numbers_international: bool = True
+    # save timings of each call to call_traces, see Database._record_call
+    trace_calls: bool = True
+    # "uvloop" or "asyncio"
+    loop_policy = 'uvloop'
+    # log the loop thread's stack when the event loop is blocked for longer than this many seconds, 0 to disable
+    loop_lag_threshold: float = 0.5
 
     # expires time on register commands, will re-register every (register_expires - 1) seconds
     register_expires = 300
+    # how often standby instances try to become leader and the leader confirms it still holds the lock, in seconds
+    leader_poll = 2
+    # seconds of silence before postgres checks the lock connection with TCP keepalives, a leader which dies or is
+    # partitioned from postgres loses the lock after about 2x this rather than the OS default of hours
+    leader_keepalive = 10
 
     @property
     def sip_uri(self):
@@ -44,7 +70,6 @@ NONCE_REGEX = re.compile('nonce="(.+?)"')
 RESPONSE_DECODE = re.compile(r'SIP/2.0 (?P<status_code>[0-9]{3}) (?P<status_message>.+)')
 REQUEST_DECODE = re.compile(r'(?P<method>[A-Za-z]+) (?P<to_uri>.+) SIP/2.0')
 FIND_BRANCH = re.compile(r'branch=(.+?);')
-NUMBER = re.compile(r'sip:\+*([\d]+)@')
 
 
 class Response(NamedTuple):
@@ -85,7 +110,62 @@ def md5digest(*args):
     return hashlib.md5(':'.join(args).encode()).hexdigest()
 
 
+def parse_datagram(raw_data: bytes):
+    headers, data = raw_data.split(b'\r\n\r\n', 1)
+    status, headers = parse_headers(headers)
+    return status, headers, data
+
+
+# unix timestamp and datagram length
+CAPTURE_HEADER = struct.Struct('>dH')
+
+
+class DatagramCapture:
+    """
+    Append-only capture of received datagrams, each record is CAPTURE_HEADER followed by the raw datagram.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = path.open('ab')
+        logger.info('capturing datagrams to %s', path)
+
+    def write(self, data: bytes):
+        self._file.write(CAPTURE_HEADER.pack(time(), len(data)) + data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path):
+    """
+    Yield (timestamp, datagram) tuples from a file written by DatagramCapture, a truncated final record is ignored.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(CAPTURE_HEADER.size)
+            if len(header) < CAPTURE_HEADER.size:
+                return
+            ts, length = CAPTURE_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield ts, data
+
+
 class Database:
+    insert_call_sql = 'INSERT INTO calls (number, country) VALUES ($1, $2)'
+    # times are microseconds after "received", later times are added by the web process, see WebsocketPropagator
+    insert_traced_call_sql = """
+    WITH c AS (
+      INSERT INTO calls (number, country) VALUES ($1, $2) RETURNING id
+    )
+    INSERT INTO call_traces (call, sip_call_id, received, parsed, dedup, db_start)
+    SELECT id, left($3, 255), to_timestamp($4), $5, $6, $7 FROM c
+    """
+
     def __init__(self, settings: Settings, loop):
         self.settings = settings
         self._pg = None
@@ -97,12 +177,38 @@ class Database:
         await conn.close()
         self._pg = await asyncpg.create_pool(dsn=self.settings.pg_dsn, min_size=2)
 
-    def record_call(self, number, country):
-        self.tasks.append(self._loop.create_task(self._record_call(number, country)))
-
-    async def _record_call(self, number, country):
-        number = number.replace(' ', '').upper()
-        await self._pg.execute('INSERT INTO calls (number, country) VALUES ($1, $2)', number, country)
+    @property
+    def pending(self):
+        return sum(not t.done() for t in self.tasks)
+
+    def record_call(self, number, country, trace=None):
+        self.tasks.append(self._loop.create_task(self._record_call(number, country, trace)))
+
+    async def _record_call(self, number, country, trace=None):
+        settings = self.settings
+        args = call_number(number, settings.default_country_code, settings.sip_numbers_international), country
+        sql = self.insert_call_sql
+        if trace:
+            received = trace['received']
+            sql = self.insert_traced_call_sql
+            args += (
+                trace['sip_call_id'],
+                received,
+                *(int((t - received) * 1e6) for t in (trace['parsed'], trace['dedup'], time())),
+            )
+        try:
+            await self._pg.execute(sql, *args)
+        except asyncpg.CheckViolationError as e:
+            if e.constraint_name:
+                # a real constraint rather than a missing partition, eg. calls_legacy_ts added by the
+                # prepare_calls_partitioning patch when calls isn't partitioned yet
+                raise RuntimeError(f'call rejected by constraint "{e.constraint_name}" on calls, if calls isn\'t '
+                                   f'partitioned yet apply migrations to partition it') from e
+            # "no partition of relation calls found for row", partitions are normally created in advance
+            # by the web process but don't rely on it
+            logger.warning('no calls partition for the current month, creating it')
+            await self._pg.execute('SELECT create_calls_partition(CURRENT_TIMESTAMP::TIMESTAMP)')
+            await self._pg.execute(sql, *args)
 
     async def complete_tasks(self):
         if self.tasks:
@@ -114,16 +220,104 @@ class Database:
         await self._pg.close()
 
 
+class Leader:
+    """
+    Leader election between backend instances sharing a database: only the instance holding a session-level
+    advisory lock registers with the SIP provider, others wait in standby and take over if the lock is released,
+    eg. because the leader died and its connection to postgres was closed.
+    """
+    # the previous leader may have sent requests after last saving its CSeq, skip ahead so ours are always higher
+    CSEQ_SKIP = 100
+    take_over_sql = """
+    INSERT INTO backend_state (call_id, leader, leader_since) VALUES ($1, $2, CURRENT_TIMESTAMP)
+    ON CONFLICT (id) DO UPDATE SET leader=EXCLUDED.leader, leader_since=EXCLUDED.leader_since
+    RETURNING call_id, cseq
+    """
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.identity = f'{socket.gethostname()}:{os.getpid()}'
+        self._conn = None
+        # time of the last successful query on the lock connection
+        self.last_contact = None
+
+    @property
+    def keepalive_settings(self):
+        keepalive = self.settings.leader_keepalive
+        return {
+            'tcp_keepalives_idle': str(keepalive),
+            'tcp_keepalives_interval': str(max(keepalive // 3, 1)),
+            'tcp_keepalives_count': '3',
+        }
+
+    async def try_acquire(self) -> bool:
+        try:
+            if not self._conn or self._conn.is_closed():
+                async with timeout(5):
+                    self._conn = await asyncpg.connect(
+                        dsn=self.settings.pg_dsn, server_settings=self.keepalive_settings
+                    )
+            async with timeout(5):
+                acquired = await self._conn.fetchval('SELECT pg_try_advisory_lock($1)', BACKEND_LOCK)
+        except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as e:
+            logger.warning('error acquiring leader lock: %s: %s', e.__class__.__name__, e)
+            await self.close()
+            return False
+        else:
+            self.last_contact = time()
+            return acquired
+
+    async def check(self) -> bool:
+        """
+        Check the connection holding the lock is still alive, if it's not the lock has been lost.
+        """
+        try:
+            async with timeout(5):
+                await self._conn.fetchval('SELECT 1')
+        except (asyncpg.PostgresError, OSError, asyncio.TimeoutError, AttributeError) as e:
+            logger.error('leader lock connection lost: %s: %s', e.__class__.__name__, e)
+            await self.close()
+            return False
+        else:
+            self.last_contact = time()
+            return True
+
+    async def take_over(self, call_id):
+        """
+        Record this instance as leader and return the Call-ID shared by all instances and the CSeq to continue from.
+        """
+        async with timeout(5):
+            r = await self._conn.fetchrow(self.take_over_sql, call_id, self.identity)
+        return r['call_id'], r['cseq'] + self.CSEQ_SKIP
+
+    async def save_cseq(self, cseq):
+        try:
+            await self._conn.execute('UPDATE backend_state SET cseq=$1', cseq)
+        except (asyncpg.PostgresError, OSError, AttributeError) as e:
+            logger.warning('error saving cseq: %s: %s', e.__class__.__name__, e)
+
+    async def close(self):
+        if self._conn:
+            try:
+                await self._conn.close()
+            except (asyncpg.PostgresError, OSError):
+                pass
+            self._conn = None
+
+
 class SipProtocol:
-    def __init__(self, connected_event, datagram_callback):
+    def __init__(self, connected_event, datagram_callback, capture: DatagramCapture=None):
         self.connected_event = connected_event
         self.datagram_callback = datagram_callback
+        self.capture = capture
 
     def connection_made(self, transport):
         logger.info('connection established')
         self.connected_event.set()
 
     def datagram_received(self, data, addr):
+        if self.capture:
+            self.capture.write(data)
         if data.startswith(b'\x00'):
             logger.debug('ping from server: %s (%s), ignoring', data, addr)
             return
@@ -163,6 +357,17 @@ class SipClient:
         self.call_cache = {}
         self.task = None
         self.stopping = None
+        self.leader = Leader(settings)
+        self.health_server = HealthServer(self)
+        self.loop_monitor = LoopLagMonitor(loop, threshold=settings.loop_lag_threshold)
+
+        self.started = time()
+        # standby until the leader lock is acquired, then leader
+        self.role = 'standby'
+        self.leader_since = None
+        self.last_registered = None
+        self.last_invite = None
+        self.calls_received = 0
 
         cache_dir = Path(self.settings.cache_dir)
         cache_dir.mkdir(exist_ok=True, parents=True)
@@ -175,43 +380,112 @@ class SipClient:
             logger.info('generated new Caller-ID: "%s", saved to %s', self.call_id, cache_file)
         else:
             logger.info('loaded Caller-ID from %s: "%s"', cache_file, self.call_id)
-        self.sentinal_file = cache_dir / settings.sentinel_file
+        self.capture = DatagramCapture(cache_dir / settings.capture_file) if settings.capture_datagrams else None
 
     async def start(self):
+        self.loop_monitor.start()
+        await self.health_server.start()
         self.task = self.loop.create_task(self.main_task())
         self.loop.add_signal_handler(signal.SIGINT, self.stop, 'sigint')
         self.loop.add_signal_handler(signal.SIGTERM, self.stop, 'sigterm')
 
     async def main_task(self):
         try:
-            while True:
-                if self.transport:
-                    logger.info('un-registering and creating new transport...')
-                    await self.register(expires=0)
-                    self.transport.close()
-
-                await self.connect_transport()
-                for i in range(20):
-                    try:
-                        re_register = await self.register(expires=self.settings.register_expires)
-                    except asyncio.TimeoutError:
-                        logger.warning('timeout error registering', exc_info=True)
-                        re_register = self.ERROR_WAIT
-                    logger.info('re-registering in %d seconds', re_register)
-                    start = time()
-                    while True:
-                        await asyncio.sleep(1)
-                        await self.db.complete_tasks()
-                        if self.stopping:
-                            return
-                        if (time() - start) > re_register:
-                            break
+            while not self.stopping:
+                if await self.wait_for_leadership():
+                    await self.run_leader()
         finally:
             logger.info('stopping reason: "%s", un-registering...', self.stopping)
-            if self.transport:
-                await self.register(expires=0)
-                self.transport.close()
+            await self.stop_registration()
+            await self.leader.close()
             await self.db.close()
+            await self.health_server.close()
+            self.loop_monitor.stop()
+            if self.capture:
+                self.capture.close()
+
+    async def wait_for_leadership(self):
+        """
+        Wait in standby until this instance holds the leader lock, returns False if stopped first.
+        """
+        logged = False
+        while not self.stopping:
+            if await self.leader.try_acquire():
+                try:
+                    self.call_id, self.cseq = await self.leader.take_over(self.call_id)
+                except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as e:
+                    # closing the connection releases the lock so another instance can try
+                    logger.warning('error taking over as leader: %s: %s', e.__class__.__name__, e)
+                    await self.leader.close()
+                else:
+                    self.role, self.leader_since = 'leader', time()
+                    # a registration from an earlier spell as leader mustn't make this one look healthy
+                    self.last_registered = None
+                    logger.info('acquired leader lock, registering with Call-ID "%s"', self.call_id)
+                    return True
+            if not logged:
+                logger.info('another instance holds the leader lock, waiting in standby')
+                logged = True
+            await asyncio.sleep(self.settings.leader_poll)
+        return False
+
+    async def run_leader(self):
+        """
+        Register and re-register until stopping or the leader lock is lost.
+        """
+        await self.connect_transport()
+        try:
+            # clear any bindings left by a previous leader, eg. one which died without un-registering
+            await self.register(expires=0, contact='*')
+        except asyncio.TimeoutError:
+            logger.warning('timeout error clearing previous registrations', exc_info=True)
+
+        while True:
+            for i in range(20):
+                try:
+                    re_register = await self.register(expires=self.settings.register_expires)
+                except asyncio.TimeoutError:
+                    logger.warning('timeout error registering', exc_info=True)
+                    re_register = self.ERROR_WAIT
+                await self.leader.save_cseq(self.cseq)
+                logger.info('re-registering in %d seconds', re_register)
+                if not await self.wait(re_register):
+                    return
+
+            logger.info('un-registering and creating new transport...')
+            await self.stop_registration()
+            await self.connect_transport()
+
+    async def wait(self, seconds):
+        """
+        Wait while completing database tasks, returns False if registration should stop.
+        """
+        start = last_check = time()
+        while True:
+            await asyncio.sleep(1)
+            await self.db.complete_tasks()
+            if self.capture:
+                self.capture.flush()
+            if self.stopping:
+                return False
+            if (time() - last_check) > self.settings.leader_poll:
+                last_check = time()
+                if not await self.leader.check():
+                    logger.error('lost leader lock, un-registering and returning to standby')
+                    self.role = 'standby'
+                    await self.stop_registration()
+                    return False
+            if (time() - start) > seconds:
+                return True
+
+    async def stop_registration(self):
+        if self.transport:
+            try:
+                await self.register(expires=0)
+            except asyncio.TimeoutError:
+                logger.warning('timeout error un-registering', exc_info=True)
+            self.transport.close()
+            self.transport = None
 
     async def run_forever(self):
         await self.task
@@ -225,18 +499,19 @@ class SipClient:
         connected = asyncio.Event()
         async with timeout(10):
             self.transport, _ = await self.loop.create_datagram_endpoint(
-                lambda: SipProtocol(connected, self.datagram_callback),
+                lambda: SipProtocol(connected, self.datagram_callback, self.capture),
                 remote_addr=addr
             )
             await connected.wait()
         self.local_ip, _ = self.transport.get_extra_info('sockname')
 
-    async def register(self, *, expires):
+    async def register(self, *, expires, contact=None):
+        contact = contact or f'<sip:{self.settings.sip_username}@{self.local_ip}>'
         common_headers = (
             f'From: <sip:{self.settings.sip_username}@{self.settings.sip_host}:{self.settings.sip_port}>',
             f'To: <sip:{self.settings.sip_username}@{self.settings.sip_host}:{self.settings.sip_port}>',
             f'Call-ID: {self.call_id}',
-            f'Contact: <sip:{self.settings.sip_username}@{self.local_ip}>',
+            f'Contact: {contact}',
             f'Expires: {expires}',
             'Max-Forwards: 70',
             'User-Agent: TutorCruncher Mithra',
@@ -284,7 +559,7 @@ class SipClient:
         else:
             re_register = max(10, expires - 1)
             logger.info('successfully registered')
-            self.sentinal_file.touch(exist_ok=True)
+            self.last_registered = time()
             return re_register
 
     def gen_branch(self):
@@ -308,12 +583,16 @@ class SipClient:
         return self.request_future
 
     def datagram_callback(self, raw_data: bytes):
-        headers, data = raw_data.split(b'\r\n\r\n', 1)
-        status, headers = parse_headers(headers)
+        received = time()
+        status, headers, data = parse_datagram(raw_data)
+        trace = {'received': received, 'parsed': time()} if self.settings.trace_calls else None
+        self.dispatch(status, headers, data, trace)
+
+    def dispatch(self, status, headers, data, trace=None):
         if 'status_code' in status:
             self.process_response(status, headers, data)
         else:
-            self.process_request(status, headers, data)
+            self.process_request(status, headers, data, trace)
 
     def process_response(self, status, headers, data):
         if self.request_future:
@@ -327,13 +606,13 @@ class SipClient:
                 }
             })
 
-    def process_request(self, status, headers, data):
+    def process_request(self, status, headers, data, trace=None):
         method = status['method']
         if method == 'OPTIONS':
             # don't care
             pass
         elif method == 'INVITE':
-            self.process_incoming_call(headers)
+            self.process_incoming_call(headers, trace)
         else:
             logger.warning('unknown request: %s', method, extra={
                 'data': {
@@ -352,21 +631,89 @@ class SipClient:
         self.call_cache[from_header] = 1
         return _existing_call
 
-    def process_incoming_call(self, headers):
+    def process_incoming_call(self, headers, trace=None):
         from_header = headers['From']
         if self.existing_call(from_header):
             return
-        m = NUMBER.search(from_header)
-        if m:
-            number = m.groups()[0]
-        else:
+        if trace:
+            trace.update(sip_call_id=headers.get('Call-ID'), dedup=time())
+        number = sip_number(from_header)
+        if not number:
             number = 'unknown'
             logger.warning('unable to find number in "%s"', from_header, extra={
                 'data': {'headers': headers}
             })
         country = headers.get('X-Brand', None)
+        self.last_invite = time()
+        self.calls_received += 1
         logger.info(f'incoming call from %s%s', number, f' ({country})' if country else '')
-        self.db.record_call(number, country)
+        self.db.record_call(number, country, trace)
+
+    def status(self):
+        """
+        Health and status from in memory state, returns (healthy, status dict).
+
+        The leader is healthy if it has registered (or became leader) within register_expires, standby instances are
+        healthy if they've successfully polled the leader lock recently.
+        """
+        now = time()
+
+        def age(ts):
+            return None if ts is None else round(now - ts, 3)
+
+        if self.role == 'leader':
+            healthy = (now - (self.last_registered or self.leader_since)) < self.settings.register_expires
+        else:
+            healthy = (now - (self.leader.last_contact or self.started)) < self.settings.leader_poll * 10
+        return healthy, {
+            'healthy': healthy,
+            'role': self.role,
+            'uptime': age(self.started),
+            'leader_age': age(self.leader_since),
+            'registration_age': age(self.last_registered),
+            'transport': 'closed' if not self.transport or self.transport.is_closing() else 'open',
+            'pending_db_writes': self.db.pending,
+            'last_invite_age': age(self.last_invite),
+            'calls_received': self.calls_received,
+            'stopping': self.stopping,
+            'loop_lag': self.loop_monitor.status(),
+        }
+
+
+class HealthServer:
+    """
+    Minimal HTTP listener answering every request with SipClient.status() as JSON, status 200 if healthy else 503.
+    """
+    def __init__(self, client: SipClient):
+        self.client = client
+        self.server = None
+
+    async def start(self):
+        settings = self.client.settings
+        self.server = await asyncio.start_server(self.handle, settings.health_host, settings.health_port,
+                                                 loop=self.client.loop)
+        logger.info('health server listening on %s:%d', settings.health_host, settings.health_port)
+
+    async def handle(self, reader, writer):
+        try:
+            async with timeout(2):
+                # only the request line matters, the request is the same whatever it contains
+                await reader.readline()
+            healthy, status = self.client.status()
+            body = json.dumps(status).encode()
+            writer.write(
+                (b'HTTP/1.0 200 OK\r\n' if healthy else b'HTTP/1.0 503 Service Unavailable\r\n') +
+                b'Content-Type: application/json\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body)
+            )
+        except (asyncio.TimeoutError, OSError) as e:
+            logger.debug('health request error %s: %s', e.__class__.__name__, e)
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
 
 
 async def setup(settings, loop):
@@ -378,8 +725,9 @@ async def setup(settings, loop):
 
 
 def main():
-    loop = asyncio.get_event_loop()
     settings = Settings()
+    set_loop_policy(settings.loop_policy)
+    loop = asyncio.get_event_loop()
     try:
         client: SipClient = loop.run_until_complete(setup(settings, loop))
         loop.run_until_complete(client.run_forever())
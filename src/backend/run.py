@@ -1,40 +1,51 @@
 #!/usr/bin/env python3.6
-import logging.config
+import json
+import os
+import socket
 import sys
 from pathlib import Path
-from time import time, sleep
 
 THIS_DIR = Path(__file__).parent
 if not Path(THIS_DIR / 'shared').exists():
     # when running outside docker
     sys.path.append(str(THIS_DIR / '..'))
 
-from shared.logs import setup_logging  # NOQA
-from main import Settings, main  # NOQA
-
-
-logger = logging.getLogger('mithra.backend.run')
-
 
 def check():
-    settings = Settings()
-    sentinal_file = Path(settings.cache_dir) / settings.sentinel_file
-    # so first check is unlikely to fail
-    sleep(2)
-    if not sentinal_file.exists():
-        logger.critical('sentinel file %s does not exist', sentinal_file)
-        sys.exit(1)
-    age = int(time() - sentinal_file.stat().st_mtime)
-    if age > settings.register_expires:
-        logger.critical('sentinel file has expired, age: %ds', age)
+    """
+    Query the backend's health listener (see HealthServer in main.py), deliberately uses only the standard library
+    so the check is quick to run.
+    """
+    # same env vars as Settings.health_host and health_port in main.py
+    host = os.getenv('APP_HEALTH_HOST', '127.0.0.1')
+    port = int(os.getenv('APP_HEALTH_PORT', 8001))
+    try:
+        with socket.create_connection((host, port), timeout=5) as sock:
+            sock.sendall(b'GET / HTTP/1.0\r\n\r\n')
+            response = sock.makefile('rb').read()
+        head, body = response.split(b'\r\n\r\n', 1)
+        status_code = int(head.split()[1])
+        status = json.loads(body.decode())
+    except (OSError, ValueError, IndexError) as e:
+        status, error = None, f'health check request failed {e.__class__.__name__}: {e}'
+    else:
+        error = None if status_code == 200 else f'backend unhealthy, status {status_code}'
+
+    if error:
+        import logging
+        from shared.logs import setup_logging
+        setup_logging(disable_existing=True)
+        logging.getLogger('mithra.backend.run').critical('%s: %s', error, status, extra={'data': {'status': status}})
         sys.exit(1)
     else:
-        logger.info('sentinel file ok, age: %ds', age)
+        print(f'backend healthy: {status}')
 
 
 if __name__ == '__main__':
-    setup_logging(disable_existing=True)
     if 'check' in sys.argv:
         check()
     else:
+        from shared.logs import setup_logging
+        from main import main
+        setup_logging(disable_existing=True)
         main()
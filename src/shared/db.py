@@ -1,4 +1,5 @@
 import asyncio
+import json
 import logging
 
 import asyncpg
@@ -8,6 +9,15 @@ from .settings import PgSettings
 
 logger = logging.getLogger('mithra.db')
 
+# keys for postgres advisory locks, these must be unique
+DOWNLOADER_LOCK = 1
+BACKEND_LOCK = 2
+MIGRATION_LOCK = 3
+CALLS_ARCHIVER_LOCK = 4
+# taken by create_calls_partition in logic.sql
+PARTITION_LOCK = 5
+CALL_STATS_LOCK = 6
+
 
 async def lenient_conn(settings, with_db=True):
     if with_db:
@@ -19,6 +29,9 @@ async def lenient_conn(settings, with_db=True):
         try:
             async with timeout(2):
                 conn = await asyncpg.connect(dsn=dsn)
+        except asyncpg.InvalidCatalogNameError:
+            # the database doesn't exist, retrying won't help
+            raise
         except (asyncpg.PostgresError, OSError) as e:
             if retry == 0:
                 raise
@@ -39,15 +52,16 @@ WHERE pg_stat_activity.datname = $1 AND pid <> pg_backend_pid();
 
 async def prepare_database(settings: PgSettings, overwrite_existing: bool) -> bool:
     """
-    (Re)create a fresh database and run migrations.
+    (Re)create a fresh database with the latest schema.
     :param settings: settings to use for db connection
     :param overwrite_existing: whether or not to drop an existing database if it exists
     :return: whether or not a database has been (re)created
     """
     conn = await lenient_conn(settings, with_db=False)
     try:
-        await conn.execute(DROP_CONNECTIONS, settings.pg_name)
-        if not overwrite_existing:
+        if overwrite_existing:
+            await conn.execute(DROP_CONNECTIONS, settings.pg_name)
+        else:
             # this check is technically unnecessary but avoids an ugly postgres error log
             exists = await conn.fetchval('SELECT 1 AS result FROM pg_database WHERE datname=$1', settings.pg_name)
             if exists:
@@ -76,7 +90,80 @@ async def prepare_database(settings: PgSettings, overwrite_existing: bool) -> bo
         logger.debug('creating tables from model definition...')
         async with conn.transaction():
             await conn.execute(settings.models_sql + '\n' + settings.logic_sql)
+            await conn.executemany('INSERT INTO schema_version (version, name) VALUES ($1, $2)',
+                                   [(version, name) for version, name, _ in settings.migrations])
     finally:
         await conn.close()
     logger.info('database successfully setup ✓')
     return True
+
+
+async def get_sync_state(conn, name) -> dict:
+    """
+    Get the state saved with set_sync_state, an empty dict if there's no state saved under name.
+    """
+    state = await conn.fetchval('SELECT state FROM sync_state WHERE name=$1', name)
+    return json.loads(state) if state else {}
+
+
+async def set_sync_state(conn, name, state: dict):
+    await conn.execute("""
+    INSERT INTO sync_state (name, state) VALUES ($1, $2)
+    ON CONFLICT (name) DO UPDATE SET state=EXCLUDED.state, updated=CURRENT_TIMESTAMP
+    """, name, json.dumps(state))
+
+
+async def get_schema_version(conn) -> int:
+    """
+    Version of the latest migration applied, 0 if the database predates schema versioning.
+    """
+    try:
+        return await conn.fetchval('SELECT max(version) FROM schema_version') or 0
+    except asyncpg.UndefinedTableError:
+        return 0
+
+
+async def run_migrations(conn, settings: PgSettings) -> int:
+    """
+    Apply migrations newer than the database's schema version then re-run logic.sql, must be called inside
+    a transaction.
+    :return: number of migrations applied
+    """
+    await conn.execute('SELECT pg_advisory_xact_lock($1)', MIGRATION_LOCK)
+    # version is checked again now we hold the lock in case another process has just migrated
+    version = 0
+    if await conn.fetchval("SELECT to_regclass('schema_version')"):
+        version = await conn.fetchval('SELECT max(version) FROM schema_version') or 0
+    pending = [m for m in settings.migrations if m[0] > version]
+    for version, name, sql in pending:
+        logger.info('applying migration %d "%s"...', version, name)
+        await conn.execute(sql)
+        await conn.execute('INSERT INTO schema_version (version, name) VALUES ($1, $2)', version, name)
+    if pending:
+        await conn.execute(settings.logic_sql)
+    return len(pending)
+
+
+async def migrate_database(settings: PgSettings):
+    """
+    Bring the database up to date on startup: normally just a check of the schema version, pending migrations are
+    applied if there are any and the database is created if it doesn't exist. Nothing here drops data.
+    """
+    try:
+        conn = await lenient_conn(settings)
+    except asyncpg.InvalidCatalogNameError:
+        await prepare_database(settings, False)
+        return
+
+    try:
+        version = await get_schema_version(conn)
+        latest = settings.migrations[-1][0]
+        if version >= latest:
+            logger.info('database schema up to date, version %d ✓', version)
+            return
+        logger.info('database schema version %d, migrating to %d...', version, latest)
+        async with conn.transaction():
+            applied = await run_migrations(conn, settings)
+        logger.info('%d migrations applied ✓', applied)
+    finally:
+        await conn.close()
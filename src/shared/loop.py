@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import sys
+import threading
+import traceback
+from time import monotonic
+
+logger = logging.getLogger('mithra.loop')
+
+
+def set_loop_policy(name):
+    """
+    Use the named event loop policy: "uvloop" or "asyncio" for the standard library's default loop.
+    """
+    if name == 'uvloop':
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    elif name != 'asyncio':
+        raise ValueError(f'unknown loop policy "{name}", options are "uvloop" and "asyncio"')
+
+
+class LoopLagMonitor:
+    """
+    Measure event loop lag: a callback is scheduled every "interval" seconds and how late it runs is recorded
+    in a histogram.
+
+    A watchdog thread notices when the callback hasn't run for more than "threshold" seconds beyond its interval,
+    ie. something is blocking the loop, and logs the stack of the loop's thread while it's still blocked.
+    """
+    # upper bounds of histogram buckets in milliseconds
+    BUCKETS = 1, 5, 10, 50, 100, 500, 1000, 5000, float('inf')
+
+    def __init__(self, loop, *, interval=0.25, threshold=0.5):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.histogram = [0] * len(self.BUCKETS)
+        self.max_lag = 0
+        self.stalls = 0
+        self._expected = None
+        self._handle = None
+        self._last_beat = None
+        self._loop_thread_id = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start monitoring, must be called from the loop's thread.
+        """
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = monotonic()
+        self._schedule()
+        if self.threshold:
+            self._thread = threading.Thread(target=self._watch, name='loop-lag-watchdog', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._handle:
+            self._handle.cancel()
+        if self._thread:
+            self._thread.join()
+
+    def _schedule(self):
+        self._expected = self.loop.time() + self.interval
+        self._handle = self.loop.call_later(self.interval, self._beat)
+
+    def _beat(self):
+        self._last_beat = monotonic()
+        self.record(max(0, self.loop.time() - self._expected))
+        self._schedule()
+
+    def record(self, lag):
+        lag_ms = lag * 1000
+        for i, bound in enumerate(self.BUCKETS):
+            if lag_ms <= bound:
+                self.histogram[i] += 1
+                break
+        self.max_lag = max(self.max_lag, lag)
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(self.threshold / 2):
+            last_beat = self._last_beat
+            blocked = monotonic() - last_beat - self.interval
+            if blocked > self.threshold and last_beat != reported:
+                # only report each stall once
+                reported = last_beat
+                self.stalls += 1
+                frame = sys._current_frames().get(self._loop_thread_id)
+                stack = ''.join(traceback.format_stack(frame)) if frame else 'unknown'
+                logger.warning('event loop blocked for %0.0fms, loop thread stack:\n%s', blocked * 1000, stack,
+                               extra={'data': {'stack': stack}})
+
+    def status(self):
+        return {
+            'max_lag_ms': round(self.max_lag * 1000, 3),
+            'stalls': self.stalls,
+            'histogram': {
+                f'<={b}ms' if b != float('inf') else f'>{self.BUCKETS[-2]}ms': n
+                for b, n in zip(self.BUCKETS, self.histogram)
+            },
+        }
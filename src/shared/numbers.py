@@ -0,0 +1,113 @@
+"""
+Phone number normalisation shared by the backend, the intercom download and call imports so numbers from every
+source are saved the same way and can be matched exactly.
+"""
+import re
+
+SIP_NUMBER = re.compile(r'sip:(\+?)\+*([\d]+)@')
+CALL_NUMBER = re.compile(r'\+*(\d+)')
+NUMBER_SEPARATORS = re.compile(r'[\s\-().]')
+CLEAN_NUMBER = re.compile(r'[^\+\d]')
+NON_DIGITS = re.compile(r'\D')
+# eg. "+44 (0) 7700 900123", the zero is a trunk prefix and shouldn't be dialed after the country code
+TRUNK_ZERO = re.compile(r'\(0\)')
+# eg. "07700 900123 ext 12", "07700 900123 x12", "07700900123#12" or "+447700900123;ext=12"
+EXTENSION = re.compile(r'\s*(?:;?ext(?:ension)?\.?=?|x|#)\s*\d+$', re.I)
+# what's left of a number once the extension is removed should only be digits, separators and a leading "+"
+VALID_NUMBER = re.compile(r'\+*[\d\s\-().]+')
+UNKNOWN_NUMBER = 'UNKNOWN'
+# countries where a zero after the country code is part of the number rather than a trunk prefix: Italy
+KEEP_ZERO = {'39'}
+
+# ITU-T E.164 country calling codes, these are prefix free so at most one is a prefix of any number.
+# Kept as a string and only expanded into COUNTRY_CODES when first needed, see country_codes()
+_COUNTRY_CODES_TABLE = (
+    '1 7 20 27 30-34 36 39 40 41 43-49 51-58 60-66 81 82 84 86 90-95 98 '
+    '211-213 216 218 220-258 260-269 290 291 297-299 350-359 370-383 385-387 389 420 421 423 500-509 590-599 '
+    '670 672-683 685-692 800 808 850 852 853 855 856 870 878 880-883 886 888 960-968 970-977 979 992-996 998'
+)
+COUNTRY_CODES = None
+# shortest and longest E.164 numbers excluding the "+"
+MIN_LENGTH, MAX_LENGTH = 8, 15
+
+
+def country_codes():
+    global COUNTRY_CODES
+    if COUNTRY_CODES is None:
+        codes = set()
+        for item in _COUNTRY_CODES_TABLE.split():
+            start, _, end = item.partition('-')
+            codes.update(str(c) for c in range(int(start), int(end or start) + 1))
+        COUNTRY_CODES = frozenset(codes)
+    return COUNTRY_CODES
+
+
+def country_code(digits):
+    """
+    Country calling code at the start of digits or None if they don't start with one.
+    """
+    codes = country_codes()
+    for length in (1, 2, 3):
+        if digits[:length] in codes:
+            return digits[:length]
+
+
+def canonical_number(number, default_country_code='44', international=False):
+    """
+    Convert a phone number to E.164 format, eg. "+447700900123", or None if it can't be.
+
+    Numbers starting "+" or "00" are international, numbers starting "0" are national numbers in
+    default_country_code. Other numbers are national too unless "international" is true, as for caller ids from SIP
+    which are usually E.164 without the "+", then they're international if they start with a country code and are
+    long enough. Extensions are removed, numbers containing anything but digits and separators aren't converted.
+    """
+    if not number:
+        return None
+    raw = EXTENSION.sub('', TRUNK_ZERO.sub('', number)).strip()
+    if not VALID_NUMBER.fullmatch(raw):
+        return None
+    digits = NON_DIGITS.sub('', raw)
+    if raw.startswith('+'):
+        pass
+    elif digits.startswith('00'):
+        digits = digits[2:]
+    elif digits.startswith('0'):
+        digits = default_country_code + digits[1:]
+    elif international and country_code(digits) and MIN_LENGTH <= len(digits) <= MAX_LENGTH:
+        pass
+    else:
+        digits = default_country_code + digits
+
+    cc = country_code(digits)
+    if cc and cc not in KEEP_ZERO and digits[len(cc):].startswith('0'):
+        # eg. "+4407700900123" from a number written "+44 (0)7700 900123" without brackets
+        digits = cc + digits[len(cc) + 1:]
+    if cc and MIN_LENGTH <= len(digits) <= MAX_LENGTH:
+        return '+' + digits
+
+
+def sip_number(from_header):
+    """
+    Caller's number from the "From" header of an INVITE, including its "+" if it has one, or None if there isn't one.
+    """
+    m = SIP_NUMBER.search(from_header)
+    return ''.join(m.groups()) if m else None
+
+
+def call_number(number, default_country_code='44', international=False):
+    """
+    Normalise a caller's number as saved in calls: E.164 if possible, otherwise digits only without any leading "+"
+    or "UNKNOWN". See canonical_number for "international".
+    """
+    canonical = canonical_number(number, default_country_code, international)
+    if canonical:
+        return canonical
+    m = CALL_NUMBER.fullmatch(NUMBER_SEPARATORS.sub('', number or ''))
+    return m.groups()[0] if m else UNKNOWN_NUMBER
+
+
+def clean_number(n, default_country_code='44'):
+    """
+    Normalise a person's number as saved in people_numbers: E.164 if possible, otherwise just digits and "+".
+    """
+    return canonical_number(n, default_country_code) or CLEAN_NUMBER.sub('', n.lower())
@@ -14,6 +14,8 @@ class PgSettings(BaseSettings):
     pg_host = 'localhost'
     pg_port = '5432'
     pg_driver = 'postgres'
+    # comma separated DSNs of read replicas which read-only web views can use, see web's ReplicaMonitor
+    pg_replica_dsns: str = None
 
     @property
     def pg_dsn(self) -> str:
@@ -27,6 +29,10 @@ class PgSettings(BaseSettings):
             query=None,
         )
 
+    @property
+    def pg_replica_dsn_list(self):
+        return [dsn.strip() for dsn in (self.pg_replica_dsns or '').split(',') if dsn.strip()]
+
     @property
     def models_sql(self):
         return (THIS_DIR / 'sql' / 'models.sql').read_text()
@@ -34,3 +40,14 @@ class PgSettings(BaseSettings):
     @property
     def logic_sql(self):
         return (THIS_DIR / 'sql' / 'logic.sql').read_text()
+
+    @property
+    def migrations(self):
+        """
+        List of (version, name, sql) from sql/migrations/{version}_{name}.sql ordered by version.
+        """
+        migrations = []
+        for path in (THIS_DIR / 'sql' / 'migrations').glob('*.sql'):
+            version, name = path.stem.split('_', 1)
+            migrations.append((int(version), name, path.read_text()))
+        return sorted(migrations)
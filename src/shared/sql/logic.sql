@@ -2,18 +2,20 @@ CREATE OR REPLACE FUNCTION fill_call() RETURNS trigger AS $$
   DECLARE
     person_id INT;
   BEGIN
+    -- set by bulk imports which match calls themselves, see import_calls in patch.py
+    IF current_setting('mithra.importing', true) = 'on' THEN
+      RETURN NEW;
+    END IF;
     SELECT p.id INTO person_id
       FROM people_numbers AS pn
       JOIN people p ON pn.person = p.id
-      WHERE pn.number ILIKE '%' || right(NEW.number, -4)
+      WHERE pn.number = NEW.number
       ORDER BY p.last_seen DESC LIMIT 1;
 
     NEW.person := person_id;
     RETURN NEW;
   END;
 $$ LANGUAGE plpgsql;
-DROP TRIGGER IF EXISTS before_calls_insert ON calls;
-CREATE TRIGGER before_calls_insert BEFORE INSERT OR UPDATE ON calls FOR EACH ROW EXECUTE PROCEDURE fill_call();
 
 CREATE OR REPLACE FUNCTION call_notify() RETURNS trigger AS $$
   DECLARE
@@ -22,11 +24,13 @@ CREATE OR REPLACE FUNCTION call_notify() RETURNS trigger AS $$
     company VARCHAR(255);
     has_support BOOLEAN;
   BEGIN
+    IF current_setting('mithra.importing', true) = 'on' THEN
+      RETURN NEW;
+    END IF;
     SELECT p.name, co.name, co.has_support INTO person_name, company, has_support
-      FROM calls
-      JOIN people AS p ON calls.person = p.id
+      FROM people AS p
       JOIN companies AS co ON p.company = co.id
-      WHERE calls.id=NEW.id;
+      WHERE p.id=NEW.person;
 
     payload := json_build_object(
       'id', NEW.id,
@@ -35,15 +39,65 @@ CREATE OR REPLACE FUNCTION call_notify() RETURNS trigger AS $$
       'ts', NEW.ts,
       'person_name', person_name,
       'company', company,
-      'has_support', has_support
+      'has_support', has_support,
+      'notify_ts', extract(epoch FROM clock_timestamp())
     );
     -- notify no channel "call"
     PERFORM pg_notify('call', payload::text);
     RETURN NEW;
   END;
 $$ LANGUAGE plpgsql;
-DROP TRIGGER IF EXISTS after_calls_insert ON calls;
-CREATE TRIGGER after_calls_insert AFTER INSERT ON calls FOR EACH ROW EXECUTE PROCEDURE call_notify();
+
+-- row triggers can't be created on a partitioned table so are created on each partition
+CREATE OR REPLACE FUNCTION calls_partition_triggers(partition_name TEXT) RETURNS VOID AS $$
+  BEGIN
+    EXECUTE format('DROP TRIGGER IF EXISTS before_calls_insert ON %I', partition_name);
+    EXECUTE format('CREATE TRIGGER before_calls_insert BEFORE INSERT OR UPDATE ON %I '
+                   'FOR EACH ROW EXECUTE PROCEDURE fill_call()', partition_name);
+    EXECUTE format('DROP TRIGGER IF EXISTS after_calls_insert ON %I', partition_name);
+    EXECUTE format('CREATE TRIGGER after_calls_insert AFTER INSERT ON %I '
+                   'FOR EACH ROW EXECUTE PROCEDURE call_notify()', partition_name);
+  END;
+$$ LANGUAGE plpgsql;
+
+-- create the partition of calls for the month containing "month" if it doesn't already exist,
+-- returns the partition's name or NULL if the month is covered by another partition, eg. calls_legacy
+CREATE OR REPLACE FUNCTION create_calls_partition(month TIMESTAMP) RETURNS TEXT AS $$
+  DECLARE
+    start TIMESTAMP := date_trunc('month', month);
+    partition_name TEXT := 'calls_' || to_char(date_trunc('month', month), 'YYYY_MM');
+  BEGIN
+    -- serialise partition creation, see PARTITION_LOCK in db.py
+    PERFORM pg_advisory_xact_lock(5);
+    IF to_regclass(partition_name) IS NOT NULL THEN
+      RETURN partition_name;
+    END IF;
+
+    EXECUTE format('CREATE TABLE %I PARTITION OF calls FOR VALUES FROM (%L) TO (%L)',
+                   partition_name, start, start + interval '1 month');
+    EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (id)', partition_name);
+    EXECUTE format('ALTER TABLE %I ADD FOREIGN KEY (person) REFERENCES people', partition_name);
+    EXECUTE format('CREATE INDEX ON %I USING btree (ts)', partition_name);
+    EXECUTE format('CREATE INDEX ON %I USING btree (person)', partition_name);
+    PERFORM calls_partition_triggers(partition_name);
+    RETURN partition_name;
+  EXCEPTION WHEN invalid_object_definition THEN
+    -- "partition would overlap"
+    RETURN NULL;
+  END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+  DECLARE
+    partition_name TEXT;
+  BEGIN
+    FOR partition_name IN SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = 'calls'::regclass LOOP
+      PERFORM calls_partition_triggers(partition_name);
+    END LOOP;
+  END;
+$$;
+SELECT create_calls_partition(CURRENT_TIMESTAMP::TIMESTAMP);
+SELECT create_calls_partition((CURRENT_TIMESTAMP + interval '1 month')::TIMESTAMP);
 
 
 CREATE OR REPLACE FUNCTION people_search() RETURNS trigger AS $$
@@ -0,0 +1,6 @@
+-- databases created before schema versioning have the original schema, this records their version from here on
+CREATE TABLE IF NOT EXISTS schema_version (
+  version INT PRIMARY KEY,
+  name VARCHAR(255) NOT NULL,
+  applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS sync_state (
+  name VARCHAR(63) PRIMARY KEY,
+  updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  state JSONB NOT NULL DEFAULT '{}'
+);
@@ -0,0 +1,7 @@
+CREATE TABLE IF NOT EXISTS backend_state (
+  id INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+  call_id VARCHAR(63) NOT NULL,
+  cseq INT NOT NULL DEFAULT 1,
+  leader VARCHAR(255),
+  leader_since TIMESTAMP
+);
@@ -0,0 +1,36 @@
+-- convert calls to a table partitioned by month, the existing table becomes the "calls_legacy" partition holding
+-- all calls before "cutoff", later months get their own partitions from create_calls_partition in logic.sql.
+-- Attaching calls_legacy would scan it while calls is locked, so this refuses to run until the
+-- "prepare_calls_partitioning" patch has added and validated the calls_legacy_ts constraint, then calls is only
+-- locked briefly. Migrations run on startup so startup fails with the error below until the patch has been run.
+DO $$
+  DECLARE
+    cutoff TIMESTAMP;
+  BEGIN
+    SELECT substring(pg_get_constraintdef(oid) FROM '''([^'']+)''')::TIMESTAMP INTO cutoff
+      FROM pg_constraint
+      WHERE conrelid = 'calls'::regclass AND conname = 'calls_legacy_ts' AND convalidated;
+    IF cutoff IS NULL THEN
+      RAISE EXCEPTION 'calls has no validated calls_legacy_ts constraint, attaching it would lock calls during a scan'
+        USING HINT = 'run "./run.py patch prepare_calls_partitioning --live" first';
+    END IF;
+
+    ALTER TABLE calls RENAME TO calls_legacy;
+    ALTER INDEX calls_pkey RENAME TO calls_legacy_pkey;
+    ALTER INDEX call_ts RENAME TO calls_legacy_ts_idx;
+    CREATE INDEX IF NOT EXISTS calls_legacy_person_idx ON calls_legacy USING btree (person);
+
+    CREATE TABLE calls (
+      id INT NOT NULL DEFAULT nextval('calls_id_seq'),
+      number VARCHAR(127) NOT NULL,
+      person INT,
+      country VARCHAR(31),
+      ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    ) PARTITION BY RANGE (ts);
+    ALTER SEQUENCE calls_id_seq OWNED BY calls.id;
+    ALTER TABLE calls_legacy ALTER COLUMN id DROP DEFAULT;
+
+    EXECUTE format('ALTER TABLE calls ATTACH PARTITION calls_legacy FOR VALUES FROM (MINVALUE) TO (%L)', cutoff);
+    ALTER TABLE calls_legacy DROP CONSTRAINT IF EXISTS calls_legacy_ts;
+  END;
+$$;
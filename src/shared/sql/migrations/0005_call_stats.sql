@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS call_stats (
+  period VARCHAR(7) NOT NULL,
+  bucket TIMESTAMP NOT NULL,
+  company INT NOT NULL DEFAULT 0,
+  country VARCHAR(31) NOT NULL DEFAULT '',
+  calls INT NOT NULL DEFAULT 0,
+  matched INT NOT NULL DEFAULT 0,
+  PRIMARY KEY (period, bucket, company, country)
+);
@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS call_traces (
+  call INT PRIMARY KEY,
+  sip_call_id VARCHAR(255),
+  received TIMESTAMPTZ NOT NULL,
+  parsed INT,
+  dedup INT,
+  db_start INT,
+  notified INT,
+  propagated INT,
+  sent INT,
+  sockets INT NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS call_traces_received ON call_traces USING btree (received);
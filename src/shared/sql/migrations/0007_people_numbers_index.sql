@@ -0,0 +1,2 @@
+-- calls are now matched to people by exact number, see fill_call and the renormalise_* patches
+CREATE INDEX IF NOT EXISTS people_numbers_number ON people_numbers USING btree (number);
@@ -2,6 +2,13 @@ DROP SCHEMA public CASCADE;
 CREATE SCHEMA public;
 CREATE EXTENSION pg_trgm;
 
+-- models.sql always creates the latest schema, prepare_database records every migration as applied
+CREATE TABLE schema_version (
+  version INT PRIMARY KEY,
+  name VARCHAR(255) NOT NULL,
+  applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
 CREATE TABLE companies (
   id SERIAL PRIMARY KEY,
   name VARCHAR(255) NOT NULL,
@@ -31,12 +38,57 @@ CREATE TABLE people_numbers (
   UNIQUE (person, number)
 );
 CREATE INDEX number_index ON people_numbers USING GIN (number gin_trgm_ops);
+CREATE INDEX people_numbers_number ON people_numbers USING btree (number);
 
+-- partitioned by month, partitions with their primary key, indexes, foreign key and triggers are created by
+-- create_calls_partition in logic.sql
 CREATE TABLE calls (
-  id SERIAL PRIMARY KEY,
+  id SERIAL,
   number VARCHAR(127) NOT NULL,
-  person INT REFERENCES people,
+  person INT,
   country VARCHAR(31),
   ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) PARTITION BY RANGE (ts);
+
+-- call counts per hour and day, maintained from calls by update_call_stats in background.py so they outlive
+-- archived calls partitions. company is 0 for calls not matched to a company and country is '' if unknown
+CREATE TABLE call_stats (
+  period VARCHAR(7) NOT NULL,
+  bucket TIMESTAMP NOT NULL,
+  company INT NOT NULL DEFAULT 0,
+  country VARCHAR(31) NOT NULL DEFAULT '',
+  calls INT NOT NULL DEFAULT 0,
+  matched INT NOT NULL DEFAULT 0,
+  PRIMARY KEY (period, bucket, company, country)
+);
+
+-- timings of each call from the backend receiving the INVITE (received) to the call being sent to websockets,
+-- each is microseconds after received: datagram parsed, duplicate check done, database insert started,
+-- call_notify ran, notification received by the first web process and sent to the last websocket
+CREATE TABLE call_traces (
+  call INT PRIMARY KEY,
+  sip_call_id VARCHAR(255),
+  received TIMESTAMPTZ NOT NULL,
+  parsed INT,
+  dedup INT,
+  db_start INT,
+  notified INT,
+  propagated INT,
+  sent INT,
+  sockets INT NOT NULL DEFAULT 0
+);
+CREATE INDEX call_traces_received ON call_traces USING btree (received);
+
+CREATE TABLE sync_state (
+  name VARCHAR(63) PRIMARY KEY,
+  updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  state JSONB NOT NULL DEFAULT '{}'
+);
+
+CREATE TABLE backend_state (
+  id INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+  call_id VARCHAR(63) NOT NULL,
+  cseq INT NOT NULL DEFAULT 1,
+  leader VARCHAR(255),
+  leader_since TIMESTAMP
 );
-CREATE INDEX call_ts ON calls USING btree (ts);
@@ -1,15 +1,24 @@
 import asyncio
+import gzip
 import json
 import logging
+import os
 import re
+import socket
+from collections import Counter, defaultdict
 from datetime import datetime, timedelta
 from pathlib import Path
 from time import time
 
 import asyncpg
 from aiohttp import ClientError, ClientSession
+from async_timeout import timeout
+
+from shared.db import CALL_STATS_LOCK, CALLS_ARCHIVER_LOCK, DOWNLOADER_LOCK, get_sync_state, set_sync_state
+from shared.numbers import clean_number
 
 from .settings import Settings
+from .utils import GoogleCerts
 
 logger = logging.getLogger('mithra.web.background')
 
@@ -37,15 +46,39 @@ class WebsocketPropagator(_Worker):
     def __init__(self, app):
         super().__init__(app)
         self.websockets = set()
-
-    def add_ws(self, ws):
+        # subscription index: brand -> websockets subscribed to that brand, None -> websockets wanting every brand
+        self.subscriptions = defaultdict(set)
+        # websockets only wanting calls from companies with support
+        self.support_only = set()
+        self._ws_brands = {}
+        # reason -> number of websockets removed because they were unresponsive or broken
+        self.reaped = Counter()
+
+    def add_ws(self, ws, brands=None, support_only=False):
         self.websockets.add(ws)
+        self._ws_brands[ws] = brands
+        for brand in brands or [None]:
+            self.subscriptions[brand].add(ws)
+        if support_only:
+            self.support_only.add(ws)
 
     def remove_ws(self, ws):
-        try:
-            self.websockets.remove(ws)
-        except KeyError:
-            pass
+        self.websockets.discard(ws)
+        self.support_only.discard(ws)
+        for brand in self._ws_brands.pop(ws, None) or [None]:
+            subscribers = self.subscriptions.get(brand)
+            if subscribers is not None:
+                subscribers.discard(ws)
+                if not subscribers:
+                    del self.subscriptions[brand]
+
+    def recipients(self, call):
+        recipients = self.subscriptions.get(None, set())
+        if call.get('country') is not None:
+            recipients = recipients | self.subscriptions.get(call['country'], set())
+        if not call.get('has_support'):
+            recipients = recipients - self.support_only
+        return set(recipients)
 
     async def run(self):
         pending_futures = set()
@@ -67,14 +100,46 @@ class WebsocketPropagator(_Worker):
                     break
             await conn.remove_listener(channel, on_event)
 
+    # each web process records when it got the notification and finished sending, see Database in the backend
+    trace_sql = """
+    UPDATE call_traces SET
+      notified = (($2 - extract(epoch FROM received)) * 1000000)::INT,
+      propagated = least(propagated, (($3 - extract(epoch FROM received)) * 1000000)::INT),
+      sent = greatest(sent, (($4 - extract(epoch FROM received)) * 1000000)::INT),
+      sockets = sockets + $5
+    WHERE call = $1
+    """
+
+    def reap(self, ws, reason):
+        self.reaped[reason] += 1
+        logger.info('ws "%s" removed: %s, total removed: %s', ws, reason, dict(self.reaped))
+        self.remove_ws(ws)
+
     async def _send(self, data):
-        logger.info('sending %s to %d connected websockets', data, len(self.websockets))
-        for ws in self.websockets:
+        received = time()
+        call = json.loads(data)
+        recipients = self.recipients(call)
+        logger.info('sending %s to %d of %d connected websockets', data, len(recipients), len(self.websockets))
+        if recipients:
+            # concurrently so one slow socket doesn't hold up the rest
+            await asyncio.gather(*(self._send_ws(ws, data) for ws in recipients))
+        if self.settings.trace_calls and 'notify_ts' in call:
             try:
-                await ws.send_str(data)
-            except (RuntimeError, AttributeError):
-                logger.info(' ws "%s" closed, removing', ws)
-                self.remove_ws(ws)
+                await self.app['pg'].execute(
+                    self.trace_sql, call['id'], call['notify_ts'], received, time(), len(recipients)
+                )
+            except asyncpg.PostgresError as e:
+                logger.warning('error saving call trace: %s', e)
+
+    async def _send_ws(self, ws, data):
+        try:
+            await asyncio.wait_for(ws.send_str(data), self.settings.ws_send_timeout)
+        except asyncio.TimeoutError:
+            self.reap(ws, 'send_timeout')
+            # the send buffer is full so closing may take a while, don't wait for it
+            asyncio.get_event_loop().create_task(ws.close())
+        except (RuntimeError, AttributeError, ConnectionError):
+            self.reap(ws, 'send_error')
 
 
 async def response_data(r):
@@ -85,7 +150,6 @@ async def response_data(r):
 
 
 EPOCH = datetime(1970, 1, 1)
-CLEAN_NUMBER = re.compile(r'[^\+\d]')
 # only deal with a few cases, doesn't have to be perfect
 STR_REPLACE = [
     (re.compile(r'&amp;'), '&'),
@@ -102,10 +166,6 @@ def from_unix_ts(ts):
     return EPOCH + timedelta(seconds=ts)
 
 
-def clean_number(n):
-    return CLEAN_NUMBER.sub('', n.lower())
-
-
 def clean_str(s):
     if isinstance(s, str):
         for regex, rep in STR_REPLACE:
@@ -116,6 +176,9 @@ def clean_str(s):
 class Downloader(_Worker):
     FREQ = 3600
     ERROR_FREQ = 600
+    # time to wait before checking again when another process is downloading
+    LOCKED_FREQ = 300
+    SYNC_STATE = 'intercom_download'
 
     async def _get(self, session, url, _retry=0):
         start = time()
@@ -138,6 +201,52 @@ class Downloader(_Worker):
                 })
                 raise RuntimeError(f'wrong response: {r.status}')
 
+    def _page_cache_path(self, endpoint):
+        return Path(self.settings.cache_dir) / f'intercom_{endpoint}.jsonl.gz'
+
+    async def _pages(self, session, endpoint):
+        """
+        Yield pages of data for an endpoint, either from intercom or from the page cache if self.from_cache.
+
+        If the intercom_page_cache setting is enabled raw pages downloaded from intercom are also written to the page
+        cache, one line of JSON per page, the cache file is only replaced once every page has been downloaded.
+        """
+        cache_path = self._page_cache_path(endpoint)
+        if self.from_cache:
+            with gzip.open(str(cache_path), 'rt') as f:
+                for line in f:
+                    yield json.loads(line)
+            return
+
+        cache_file, tmp_path = None, cache_path.with_suffix('.tmp')
+        if self.settings.intercom_page_cache:
+            cache_file = gzip.open(str(tmp_path), 'wt')
+        try:
+            for page in range(1, int(1e6)):
+                data = await self._get(session, f'{self.settings.intercom_url}/{endpoint}?per_page=60&page={page}')
+                if cache_file:
+                    cache_file.write(json.dumps(data) + '\n')
+                yield data
+                if not data['pages']['next']:
+                    break
+        except BaseException:
+            if cache_file:
+                cache_file.close()
+                tmp_path.unlink()
+            raise
+        else:
+            if cache_file:
+                cache_file.close()
+                tmp_path.rename(cache_path)
+                logger.info('%s pages cached to %s', endpoint, cache_path)
+
+    async def _db(self, coro):
+        start = time()
+        try:
+            return await coro
+        finally:
+            self.db_time += time() - start
+
     companies_insert_sql = """
     INSERT INTO companies (name, ic_id, created, login_url, has_support, details)
                    VALUES ($1,   $2,    $3,      $4,        $5,          $6)
@@ -153,16 +262,15 @@ class Downloader(_Worker):
     async def update_companies(self, session, conn):
         start = time()
         # pre-fill companies in case intercom misses some
-        company_lookup = dict(await conn.fetch('SELECT ic_id, id FROM companies'))
+        company_lookup = dict(await self._db(conn.fetch('SELECT ic_id, id FROM companies')))
         stmt = await conn.prepare(self.companies_insert_sql)
-        for page in range(1, int(1e6)):
-            data = await self._get(session, f'https://api.intercom.io/companies?per_page=60&page={page}')
+        async for data in self._pages(session, 'companies'):
             for company in data['companies']:
                 company_ic_id = company['id']
                 custom_attributes = {k: clean_str(v) for k, v in company['custom_attributes'].items()}
                 login_url = custom_attributes.pop('login_url', None)
                 support_package = custom_attributes.pop('support_package', None)
-                company_lookup[company_ic_id] = await stmt.fetchval(
+                company_lookup[company_ic_id] = await self._db(stmt.fetchval(
                     clean_str(company.get('name') or company['company_id']),
                     company_ic_id,
                     from_unix_ts(company['created_at']),
@@ -175,10 +283,9 @@ class Downloader(_Worker):
                         plan_name=company['plan'].get('name'),
                         **custom_attributes,
                     ))
-                )
-            if not data['pages']['next']:
-                logger.info('updated %d companies in %0.2f seconds', len(company_lookup), time() - start)
-                return company_lookup
+                ))
+        logger.info('updated %d companies in %0.2f seconds', len(company_lookup), time() - start)
+        return company_lookup
 
     people_name_match_sql = """
     SELECT id, last_seen
@@ -216,8 +323,7 @@ class Downloader(_Worker):
         number_stmt = await conn.prepare(self.number_insert_sql)
         downloaded, updated, duplicates = 0, 0, 0
         ignore = {'Clients', 'Contractors', 'Agents', 'ServiceRecipients'}
-        for page in range(1, int(1e6)):
-            data = await self._get(session, f'https://api.intercom.io/users?per_page=60&page={page}')
+        async for data in self._pages(session, 'users'):
             for user in data['users']:
                 downloaded += 1
                 if not user['phone'] or user['name'] in ignore:
@@ -239,60 +345,90 @@ class Downloader(_Worker):
                     country=clean_str(user['location_data'].get('country_name')),
                 ))
 
-                r = await people_match_stmt.fetchrow(company, ic_id, name)
+                r = await self._db(people_match_stmt.fetchrow(company, ic_id, name))
                 if r:
                     user_id, prev_last_seen = r
                     duplicates += 1
                     if last_seen > prev_last_seen:
                         # can't be bothered with prepared statements here
-                        await conn.execute(self.people_update_last_seen_sql, last_seen, details, user_id)
+                        await self._db(conn.execute(self.people_update_last_seen_sql, last_seen, details, user_id))
                     else:
-                        await conn.execute(self.people_update_sql, details, user_id)
+                        await self._db(conn.execute(self.people_update_sql, details, user_id))
                 else:
-                    user_id = await people_stmt.fetchval(
+                    user_id = await self._db(people_stmt.fetchval(
                         name,
                         ic_id,
                         company,
                         last_seen,
                         details,
-                    )
+                    ))
 
-                await number_stmt.fetchval(user_id, clean_number(user['phone']))
+                number = clean_number(user['phone'], self.settings.default_country_code)
+                await self._db(number_stmt.fetchval(user_id, number))
                 updated += 1
-            if not data['pages']['next']:
-                t = time() - start
-                logger.info('downloaded %d people, updated %d with %d duplicates in %0.2f seconds',
-                            downloaded, updated, duplicates, t)
-                return company_lookup
+        logger.info('downloaded %d people, updated %d with %d duplicates in %0.2f seconds',
+                    downloaded, updated, duplicates, time() - start)
+        return company_lookup
 
     async def match_existing_calls(self, conn):
         # no-op update will execute the fill_call function and fill in person where applicable
-        r = await conn.execute("""
+        r = await self._db(conn.execute("""
         UPDATE calls SET id=id
         WHERE person IS NULL
-        """)
+        """))
         logger.info('updated calls with no person: %s', r)
 
-    async def download(self, force=False):
-        if not self.settings.intercom_key:
+    async def download(self, force=False, from_cache=False):
+        """
+        Download (or rebuild from the page cache) companies and people, returns the number of seconds to wait
+        before calling download again.
+
+        Only one process may download at a time, this is enforced with a postgres advisory lock, the time of the last
+        successful download is saved in sync_state so other processes know when the next download is due.
+        """
+        self.request_time = 0
+        self.db_time = 0
+        self.from_cache = from_cache
+        if not from_cache and not self.settings.intercom_key:
             logger.info("intercom key not set, can't download data")
             return self.FREQ
 
-        self.request_time = 0
+        Path(self.settings.cache_dir).mkdir(exist_ok=True, parents=True)
+        while 'pg' not in self.app:
+            await asyncio.sleep(0.1)
+
+        async with self.app['pg'].acquire() as conn:
+            if not await conn.fetchval('SELECT pg_try_advisory_lock($1)', DOWNLOADER_LOCK):
+                logger.info('intercom download running in another process')
+                return self.LOCKED_FREQ
+            try:
+                if from_cache:
+                    return await self._rebuild_from_cache(conn)
+                else:
+                    return await self._download(conn, force)
+            finally:
+                await conn.execute('SELECT pg_advisory_unlock($1)', DOWNLOADER_LOCK)
+
+    async def _rebuild_from_cache(self, conn):
         start = time()
-        cache_dir = Path(self.settings.cache_dir)
-        cache_dir.mkdir(exist_ok=True, parents=True)
-        cache_file = cache_dir / 'download_last_run.txt'
-        try:
-            age = int(start) - int(cache_file.read_text())
-        except (FileNotFoundError, ValueError):
-            pass
-        else:
+        logger.info('rebuilding from intercom page cache in %s...', self.settings.cache_dir)
+        company_lookup = await self.update_companies(None, conn)
+        await self.update_people(None, conn, company_lookup)
+        await self.match_existing_calls(conn)
+        logger.info('companies and people rebuilt from cache in %0.2fs, db time %0.2fs',
+                    time() - start, self.db_time)
+        return self.FREQ
+
+    async def _download(self, conn, force):
+        start = time()
+        last_run = (await get_sync_state(conn, self.SYNC_STATE)).get('last_run')
+        if last_run:
+            age = int(start - last_run)
             if age < (self.FREQ - 60):
                 if force:
-                    logger.info('download run recently (%s), forcing download', cache_file)
+                    logger.info('download run recently (%ds ago), forcing download', age)
                 else:
-                    logger.info('download run recently (%s)', cache_file)
+                    logger.info('download run recently (%ds ago)', age)
                     return self.FREQ - age
 
         headers = {
@@ -300,18 +436,23 @@ class Downloader(_Worker):
             'Accept': 'application/json',
             'Authorization': f'Bearer {self.settings.intercom_key}'
         }
-        while 'pg' not in self.app:
-            await asyncio.sleep(0.1)
         logger.info('running intercom download...')
         async with ClientSession(headers=headers) as session:
-            async with self.app['pg'].acquire() as conn:
-                company_lookup = await self.update_companies(session, conn)
-                await self.update_people(session, conn, company_lookup)
-                await self.match_existing_calls(conn)
-
-        logger.info('companies and people updated from intercom in %0.2fs, total request time %0.2fs',
-                    time() - start, self.request_time)
-        cache_file.write_text(f'{start:0.0f}')
+            company_lookup = await self.update_companies(session, conn)
+            await self.update_people(session, conn, company_lookup)
+            await self.match_existing_calls(conn)
+
+        duration = time() - start
+        logger.info('companies and people updated from intercom in %0.2fs, total request time %0.2fs, db time %0.2fs',
+                    duration, self.request_time, self.db_time)
+        await set_sync_state(conn, self.SYNC_STATE, {
+            'last_run': start,
+            'duration': duration,
+            'request_time': self.request_time,
+            'db_time': self.db_time,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+        })
         return self.FREQ
 
     async def run(self):
@@ -329,7 +470,250 @@ class Downloader(_Worker):
                     return
 
 
-async def download_from_intercom(settings, force=False):
+class CallsArchiver(_Worker):
+    """
+    Look after the monthly partitions of calls: create next month's partition in advance and, if
+    calls_retention_months is set, export partitions older than that to gzipped CSV files in cache_dir before
+    detaching and dropping them. Also deletes old call_traces.
+    """
+    FREQ = 3600
+    ERROR_FREQ = 600
+    TRACE_RETENTION_DAYS = 30
+    # partitions whose upper bound is at or before the start of the month calls_retention_months ago
+    expired_partitions_sql = """
+    SELECT c.relname
+    FROM pg_inherits AS i
+    JOIN pg_class AS c ON i.inhrelid = c.oid
+    WHERE i.inhparent = 'calls'::regclass AND
+      substring(pg_get_expr(c.relpartbound, c.oid) FROM 'TO \\(''([^'']+)''\\)')::TIMESTAMP <=
+      date_trunc('month', CURRENT_TIMESTAMP) - $1::INT * interval '1 month'
+    ORDER BY c.relname
+    """
+
+    delete_traces_sql = "DELETE FROM call_traces WHERE received < CURRENT_TIMESTAMP - $1::INT * interval '1 day'"
+
+    @property
+    def archive_dir(self):
+        return Path(self.settings.cache_dir) / 'calls_archive'
+
+    async def archive(self):
+        while 'pg' not in self.app:
+            await asyncio.sleep(0.1)
+
+        async with self.app['pg'].acquire() as conn:
+            if not await conn.fetchval('SELECT pg_try_advisory_lock($1)', CALLS_ARCHIVER_LOCK):
+                logger.info('calls archiver running in another process')
+                return
+            try:
+                await conn.execute("SELECT create_calls_partition((CURRENT_TIMESTAMP + interval '1 month')::TIMESTAMP)")
+                await conn.execute(self.delete_traces_sql, self.TRACE_RETENTION_DAYS)
+                if self.settings.calls_retention_months:
+                    for name in await conn.fetch(self.expired_partitions_sql, self.settings.calls_retention_months):
+                        await self.archive_partition(conn, name[0])
+            finally:
+                await conn.execute('SELECT pg_advisory_unlock($1)', CALLS_ARCHIVER_LOCK)
+
+    async def archive_partition(self, conn, name):
+        start = time()
+        self.archive_dir.mkdir(exist_ok=True, parents=True)
+        path = self.archive_dir / f'{name}.csv.gz'
+        tmp_path = path.with_name(f'{name}.tmp')
+        loop = asyncio.get_event_loop()
+        with gzip.open(tmp_path, 'wb') as f:
+            async def write(data):
+                # compressing and writing a chunk blocks, so happens in a thread to keep the event loop responsive
+                await loop.run_in_executor(None, f.write, data)
+            await conn.copy_from_table(name, output=write, format='csv', header=True)
+        tmp_path.rename(path)
+
+        # the partition is only dropped once it's safely exported, both are fast and don't need to scan calls
+        async with conn.transaction():
+            await conn.execute(f'ALTER TABLE calls DETACH PARTITION "{name}"')
+            await conn.execute(f'DROP TABLE "{name}"')
+        logger.info('calls partition %s archived to %s and dropped in %0.2fs', name, path, time() - start)
+
+    async def run(self):
+        while True:
+            try:
+                await self.archive()
+            except Exception as e:
+                logger.exception('Error running calls archiver: %s', e)
+                wait = self.ERROR_FREQ
+            else:
+                wait = self.FREQ
+
+            for i in range(wait):
+                await asyncio.sleep(1)
+                if not self.running:
+                    return
+
+
+CALL_STATS_STATE = 'call_stats'
+CALL_STATS_PERIODS = 'hour', 'day'
+call_stats_max_id_sql = """
+SELECT max(id) FROM calls
+WHERE id > $1 AND ts < CURRENT_TIMESTAMP - $2::INT * interval '1 second'
+"""
+call_stats_update_sql = """
+INSERT INTO call_stats (period, bucket, company, country, calls, matched)
+SELECT $1, date_trunc($1, c.ts), coalesce(p.company, 0), coalesce(c.country, ''), count(*), count(c.person)
+FROM calls AS c
+LEFT JOIN people AS p ON c.person = p.id
+WHERE c.id > $2 AND c.id <= $3
+GROUP BY 2, 3, 4
+ON CONFLICT (period, bucket, company, country) DO UPDATE SET
+  calls = call_stats.calls + EXCLUDED.calls,
+  matched = call_stats.matched + EXCLUDED.matched
+"""
+
+
+async def update_call_stats(conn, *, lag=30, rebuild=False):
+    """
+    Add calls since the last update to call_stats, must be called inside a transaction.
+
+    Calls are counted once by id, calls from the last "lag" seconds are left for the next update so calls from
+    transactions which haven't yet committed aren't skipped. Calls are counted against the company they're
+    matched to at the time, rebuild=True recounts everything still in the calls table.
+    :return: id of the last call counted or None if there were no new calls
+    """
+    await conn.execute('SELECT pg_advisory_xact_lock($1)', CALL_STATS_LOCK)
+    last_id = 0
+    if rebuild:
+        await conn.execute("DELETE FROM call_stats WHERE bucket >= (SELECT date_trunc('day', min(ts)) FROM calls)")
+    else:
+        last_id = (await get_sync_state(conn, CALL_STATS_STATE)).get('last_id', 0)
+
+    max_id = await conn.fetchval(call_stats_max_id_sql, last_id, lag)
+    if max_id is None:
+        return
+    for period in CALL_STATS_PERIODS:
+        await conn.execute(call_stats_update_sql, period, last_id, max_id)
+    await set_sync_state(conn, CALL_STATS_STATE, {'last_id': max_id})
+    return max_id
+
+
+class CallStatsAggregator(_Worker):
+    FREQ = 60
+
+    async def run(self):
+        while 'pg' not in self.app:
+            await asyncio.sleep(0.1)
+        while True:
+            start = time()
+            try:
+                async with self.app['pg'].acquire() as conn:
+                    async with conn.transaction():
+                        last_id = await update_call_stats(conn)
+            except Exception as e:
+                logger.exception('Error updating call stats: %s', e)
+            else:
+                if last_id:
+                    logger.info('call stats updated to call %d in %0.2fs', last_id, time() - start)
+
+            for i in range(self.FREQ):
+                await asyncio.sleep(1)
+                if not self.running:
+                    return
+
+
+class GoogleCertsRefresher(_Worker):
+    """
+    Fetch google's certs at startup and again shortly before they expire so sign-ins only have to verify
+    tokens locally, see GoogleCerts.
+    """
+    ERROR_FREQ = 60
+
+    async def run(self):
+        certs: GoogleCerts = self.app['google_certs']
+        while True:
+            try:
+                await certs.refresh()
+            except Exception as e:
+                logger.exception('Error refreshing google certs: %s', e)
+                wait = self.ERROR_FREQ
+            else:
+                wait = max(int(certs.ttl()) - certs.REFRESH_MARGIN, self.ERROR_FREQ)
+
+            for i in range(wait):
+                await asyncio.sleep(1)
+                if not self.running:
+                    return
+
+
+class ReplicaMonitor(_Worker):
+    """
+    Check how far each read replica (app['pg_ro']) is behind the primary so read-only views only use replicas
+    which are up to date enough, see pool().
+    """
+    FREQ = 5
+    TIMEOUT = 2
+    lag_sql = """
+    SELECT CASE
+      WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+      ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END
+    """
+
+    def __init__(self, app, start=True):
+        super().__init__(app, start)
+        # replica pool -> seconds it's behind the primary, None if it couldn't be checked
+        self.lags = {}
+        self._next = 0
+
+    def pool(self, max_lag):
+        """
+        A replica pool (in turn) no more than max_lag seconds behind the primary or the primary pool if there isn't one.
+        """
+        pools = [pool for pool, lag in self.lags.items() if lag is not None and lag <= max_lag]
+        if not pools:
+            return self.app['pg']
+        self._next += 1
+        return pools[self._next % len(pools)]
+
+    async def check(self, pool):
+        """
+        Seconds the replica is behind the primary or None if that can't be found, in which case it isn't used.
+        """
+        try:
+            async with timeout(self.TIMEOUT):
+                lag = await pool.fetchval(self.lag_sql)
+        except Exception as e:
+            if self.lags.get(pool) is not None:
+                logger.warning('replica unavailable: %s: %s', e.__class__.__name__, e)
+            return None
+        if lag is None:
+            if self.lags.get(pool) is not None:
+                logger.warning('replica lag unknown, not using it')
+            return None
+        if lag > self.settings.pg_replica_max_lag >= (self.lags.get(pool) or 0):
+            logger.warning('replica %0.1fs behind the primary', lag)
+        return lag
+
+    async def update(self):
+        try:
+            lags = await asyncio.gather(*(self.check(pool) for pool in self.app['pg_ro']))
+        except Exception as e:
+            # stop using every replica rather than trusting lags which are out of date
+            logger.exception('Error checking replicas: %s', e)
+            self.lags = {}
+        else:
+            self.lags = dict(zip(self.app['pg_ro'], lags))
+
+    async def run(self):
+        while 'pg_ro' not in self.app:
+            await asyncio.sleep(0.1)
+        if not self.app['pg_ro']:
+            return
+        while True:
+            await self.update()
+
+            for i in range(self.FREQ):
+                await asyncio.sleep(1)
+                if not self.running:
+                    return
+
+
+async def download_from_intercom(settings, force=False, from_cache=False):
     pg = await asyncpg.create_pool(dsn=settings.pg_dsn, min_size=1)
     downloader = Downloader({'settings': settings, 'pg': pg}, start=False)
-    await downloader.download(force)
+    await downloader.download(force, from_cache)
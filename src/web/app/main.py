@@ -5,27 +5,41 @@ import re
 from html import escape
 
 import asyncpg
-from aiohttp import web
+from aiohttp import ClientSession, web
 from aiohttp_session import session_middleware
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
 
-from shared.db import prepare_database
+from shared.db import migrate_database
 from shared.logs import setup_logging
+from shared.loop import LoopLagMonitor
 
-from .background import Downloader, WebsocketPropagator
+from .background import (CallsArchiver, CallStatsAggregator, Downloader, GoogleCertsRefresher, ReplicaMonitor,
+                         WebsocketPropagator)
 from .middleware import auth_middleware, error_middleware
 from .settings import THIS_DIR, Settings
-from .views import (call_details, companies, company_details, index, main_ws, people, person_details, search,
-                    signin_with_google, signout)
+from .utils import GoogleCerts, Precompressed, set_json_encoder
+from .views import (call_details, call_latency, call_stats, companies, company_details, export, index, main_ws, people,
+                    person_details, search, signin_with_google, signout, status)
 
 
 async def startup(app: web.Application):
     settings: Settings = app['settings']
-    await prepare_database(settings, False)
+    app['loop_monitor'] = LoopLagMonitor(app.loop, threshold=settings.loop_lag_threshold)
+    app['loop_monitor'].start()
+    await migrate_database(settings)
+    # shared by requests to other services, currently just google's certs
+    app['http_session'] = ClientSession(conn_timeout=10, read_timeout=10)
+    app['google_certs'] = GoogleCerts(settings.google_certs_url, app['http_session'])
     app.update(
         pg=await asyncpg.create_pool(dsn=settings.pg_dsn, min_size=2),
+        # min_size=0 so a replica which is down doesn't stop the app starting, ReplicaMonitor won't use it
+        pg_ro=[await asyncpg.create_pool(dsn=dsn, min_size=0) for dsn in settings.pg_replica_dsn_list],
+        replica_monitor=ReplicaMonitor(app),
+        google_certs_refresher=GoogleCertsRefresher(app),
         ws_propagator=WebsocketPropagator(app),
         downloader=Downloader(app),
+        calls_archiver=CallsArchiver(app),
+        call_stats_aggregator=CallStatsAggregator(app),
     )
 
 
@@ -33,8 +47,14 @@ async def cleanup(app: web.Application):
     await asyncio.gather(
         app['ws_propagator'].close(),
         app['downloader'].close(),
+        app['calls_archiver'].close(),
+        app['call_stats_aggregator'].close(),
+        app['google_certs_refresher'].close(),
+        app['replica_monitor'].close(),
     )
-    await app['pg'].close()
+    await app['http_session'].close()
+    await asyncio.gather(app['pg'].close(), *(pool.close() for pool in app['pg_ro']))
+    app['loop_monitor'].stop()
 
 
 def setup_routes(app):
@@ -48,6 +68,10 @@ def setup_routes(app):
     app.router.add_get('/api/people/{id:\d+}/', person_details, name='person-details')
     app.router.add_get('/api/companies/{id:\d+}/', company_details, name='company-details')
     app.router.add_get('/api/search/', search, name='search')
+    app.router.add_get('/api/status/', status, name='status')
+    app.router.add_get('/api/stats/', call_stats, name='call-stats')
+    app.router.add_get('/api/stats/latency/', call_latency, name='call-latency')
+    app.router.add_get('/api/export/{kind:calls|people|companies}/', export, name='export')
 
     app.router.add_post('/api/signin/', signin_with_google, name='signin')
     app.router.add_post('/api/signout/', signout, name='signout')
@@ -56,6 +80,7 @@ def setup_routes(app):
 def create_app(*, settings: Settings=None):
     settings = settings or Settings()
     setup_logging()
+    set_json_encoder(settings.json_encoder)
 
     secret_key = base64.urlsafe_b64decode(settings.auth_key)
     app = web.Application(middlewares=(
@@ -73,7 +98,7 @@ def create_app(*, settings: Settings=None):
     index_html = (THIS_DIR / 'index.html').read_text()
     for key, value in ctx.items():
         index_html = re.sub(r'\{\{ ?%s ?\}\}' % key, escape(value), index_html)
-    app['index_html'] = index_html
+    app['index_html'] = Precompressed(index_html.encode(), 'text/html', charset='utf-8')
     app.on_startup.append(startup)
     app.on_cleanup.append(cleanup)
 
@@ -1,8 +1,16 @@
 import asyncio
+import csv
+import json
 import os
+from time import time
 
-from shared.db import lenient_conn, prepare_database
+import asyncpg
 
+from shared.db import (CALL_STATS_LOCK, get_schema_version, get_sync_state, lenient_conn, prepare_database,
+                       run_migrations, set_sync_state)
+from shared.numbers import call_number, clean_number
+
+from .background import update_call_stats
 from .settings import Settings
 
 patches = []
@@ -23,7 +31,20 @@ def patch(func):
     return func
 
 
-def run_patch(settings: Settings, live, patch_name):
+def chunked_patch(func):
+    """
+    Register a patch which works through a large table in chunks, each chunk is committed separately so locks are
+    only held briefly and the patch can be stopped and resumed, see _run_chunked_patch.
+
+    The patch is called repeatedly with last_key (None for the first chunk) and chunk_size and should process
+    up to chunk_size rows after last_key, returning (key of the last row processed, rows processed) or
+    (None, 0) when there's nothing left.
+    """
+    func.chunked = True
+    return patch(func)
+
+
+def run_patch(settings: Settings, live, patch_name, args=()):
     if patch_name is None:
         print('available patches:\n{}'.format(
             '\n'.join('  {}: {}'.format(p.__name__, p.__doc__.strip('\n ')) for p in patches)
@@ -37,16 +58,19 @@ def run_patch(settings: Settings, live, patch_name):
 
     print(f'running patch {patch_name} live {live}')
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(_run_patch(settings, live, patch_func))
+    if getattr(patch_func, 'chunked', False):
+        loop.run_until_complete(_run_chunked_patch(settings, live, patch_func, list(args)))
+    else:
+        loop.run_until_complete(_run_patch(settings, live, patch_func, list(args)))
 
 
-async def _run_patch(settings, live, patch_func):
+async def _run_patch(settings, live, patch_func, args):
     conn = await lenient_conn(settings)
     tr = conn.transaction()
     await tr.start()
     print('=' * 40)
     try:
-        await patch_func(conn, settings=settings, live=live)
+        await patch_func(conn, settings=settings, live=live, args=args)
     except BaseException as e:
         print('=' * 40)
         await tr.rollback()
@@ -63,6 +87,101 @@ async def _run_patch(settings, live, patch_func):
         await conn.close()
 
 
+CHUNK_OPTIONS = {
+    # rows passed to each call of the patch
+    'chunk_size': 1000,
+    # maximum rows per second, 0 for no limit
+    'max_rate': 0,
+    # seconds each chunk waits for a lock before giving up and retrying, so chunks never hold up inserts for long
+    'lock_timeout': 2,
+}
+
+
+class _RollbackChunk(Exception):
+    pass
+
+
+def _chunk_options(args):
+    """
+    Split chunked patch arguments into options (see CHUNK_OPTIONS) and arguments for the patch itself.
+    """
+    options = dict(CHUNK_OPTIONS)
+    patch_args = []
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if key in options:
+            options[key] = float(value) if key == 'max_rate' else int(value)
+        elif arg != 'restart':
+            patch_args.append(arg)
+    return options, patch_args
+
+
+async def _run_chunk(conn, patch_func, *, live, options, state_name, total_rows, **kwargs):
+    """
+    Run one chunk in its own transaction and save the checkpoint with it, the chunk is retried if a lock isn't
+    available. Without live the chunk is rolled back and _RollbackChunk raised.
+    """
+    while True:
+        try:
+            async with conn.transaction():
+                await conn.execute(f"SET LOCAL lock_timeout = '{options['lock_timeout']}s'")
+                key, rows = await patch_func(conn, live=live, chunk_size=options['chunk_size'], **kwargs)
+                if not live:
+                    print(f'not live, rolling back chunk of {rows} rows, last key {key}')
+                    raise _RollbackChunk()
+                if key is not None:
+                    await set_sync_state(conn, state_name, {'last_key': key, 'rows': total_rows + rows})
+                return key, rows
+        except asyncpg.LockNotAvailableError:
+            print(f'lock not available after {options["lock_timeout"]}s, retrying chunk...')
+            await asyncio.sleep(options['lock_timeout'])
+
+
+async def _run_chunked_patch(settings, live, patch_func, args):
+    """
+    Run a chunked patch: each chunk runs and commits in its own transaction and the key of the last row processed is
+    saved in sync_state as "patch:<name>" with the same transaction, running the patch again resumes from there.
+
+    Options are passed as arguments: chunk_size=<rows>, max_rate=<rows per second>, lock_timeout=<seconds> and
+    "restart" to ignore any saved checkpoint. Without --live a single chunk is run and rolled back.
+    """
+    options, patch_args = _chunk_options(args)
+    state_name = f'patch:{patch_func.__name__}'
+
+    conn = await lenient_conn(settings)
+    try:
+        state = {} if 'restart' in args else await get_sync_state(conn, state_name)
+        last_key, total_rows, chunks = state.get('last_key'), state.get('rows', 0), 0
+        if last_key is not None:
+            print(f'resuming from key {last_key}, {total_rows} rows already processed')
+        print('=' * 40)
+        start = time()
+        while True:
+            chunk_start = time()
+            try:
+                key, rows = await _run_chunk(conn, patch_func, live=live, options=options, state_name=state_name,
+                                             total_rows=total_rows, settings=settings, args=patch_args,
+                                             last_key=last_key)
+            except _RollbackChunk:
+                break
+
+            if key is None:
+                break
+            last_key = key
+            total_rows += rows
+            chunks += 1
+            duration = max(time() - start, 1e-6)
+            print(f'chunk {chunks}: {rows} rows in {time() - chunk_start:0.2f}s, last key {key}, '
+                  f'{total_rows} rows total, {total_rows / duration:0.0f} rows/s')
+            if options['max_rate']:
+                await asyncio.sleep(max(0, rows / options['max_rate'] - (time() - chunk_start)))
+        print('=' * 40)
+        if live:
+            print(f'finished, {chunks} chunks committed in {time() - start:0.2f}s, {total_rows} rows total')
+    finally:
+        await conn.close()
+
+
 @patch
 async def print_tables(conn, **kwargs):
     """
@@ -99,3 +218,203 @@ async def run_logic_sql(conn, settings, **kwargs):
     run logic.sql code.
     """
     await conn.execute(settings.logic_sql)
+
+
+@patch
+async def migrate(conn, settings, **kwargs):
+    """
+    apply pending schema migrations.
+    """
+    applied = await run_migrations(conn, settings)
+    print(f'{applied} migrations applied, schema version {await get_schema_version(conn)}')
+
+
+@patch
+async def prepare_calls_partitioning(conn, settings, live, **kwargs):
+    """
+    prepare an unpartitioned calls table for migration 4 (partitioning calls), which refuses to run until this has.
+    """
+    if await conn.fetchval("SELECT relkind FROM pg_class WHERE relname='calls'") == 'p':
+        print('calls is already partitioned')
+        return
+    cutoff = await conn.fetchval("SELECT (date_trunc('month', CURRENT_TIMESTAMP) + interval '2 months')::TIMESTAMP")
+    print(f'calls before {cutoff:%Y-%m-%d} will be in the calls_legacy partition, apply migrations before then: '
+          f'the backend can\'t save calls after it until calls is partitioned')
+    if not live:
+        print('not live, nothing done')
+        return
+
+    # these can't run in the patch's transaction: CREATE INDEX CONCURRENTLY can't run in a transaction and
+    # the constraint must be committed before it's validated so inserts aren't blocked while calls is scanned
+    auto_conn = await lenient_conn(settings)
+    try:
+        print('creating index on person...')
+        await auto_conn.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS calls_legacy_person_idx ON calls (person)')
+        print('adding constraint on ts...')
+        await auto_conn.execute('ALTER TABLE calls DROP CONSTRAINT IF EXISTS calls_legacy_ts')
+        await auto_conn.execute(f"ALTER TABLE calls ADD CONSTRAINT calls_legacy_ts CHECK (ts < '{cutoff}') NOT VALID")
+        print('validating constraint...')
+        await auto_conn.execute('ALTER TABLE calls VALIDATE CONSTRAINT calls_legacy_ts')
+    finally:
+        await auto_conn.close()
+
+
+@patch
+async def rebuild_call_stats(conn, **kwargs):
+    """
+    recount call_stats from calls, eg. after calls have been matched to different companies.
+    """
+    last_id = await update_call_stats(conn, rebuild=True)
+    print(f'call stats rebuilt up to call {last_id}')
+
+
+IMPORT_BATCH = 10000
+import_calls_sql = """
+INSERT INTO calls (number, country, ts, person)
+SELECT i.number, i.country, i.ts::TIMESTAMP, n.person
+FROM import_calls AS i
+LEFT JOIN import_numbers AS n ON i.number = n.number
+"""
+# the same match as fill_call in logic.sql but once per number rather than once per call
+import_numbers_sql = """
+CREATE TEMPORARY TABLE import_numbers ON COMMIT DROP AS
+SELECT DISTINCT ON (n.number) n.number, p.id AS person
+FROM (SELECT DISTINCT number FROM import_calls) AS n
+JOIN people_numbers AS pn ON pn.number = n.number
+JOIN people AS p ON pn.person = p.id
+ORDER BY n.number, p.last_seen DESC
+"""
+
+
+@patch
+async def import_calls(conn, settings, args, **kwargs):
+    """
+    import calls from a CSV file: "import_calls <path> [number=<column>] [ts=<column>] [country=<column>]",
+    columns default to "number", "ts" and "country", country is optional. Needs INSERT on calls and TEMPORARY on
+    the database, not superuser, and a logic.sql with mithra.importing (see run_logic_sql).
+    """
+    if not args:
+        raise RuntimeError('path to CSV file required')
+    path, *column_args = args
+    columns = {'number': 'number', 'ts': 'ts', 'country': 'country'}
+    columns.update(a.split('=', 1) for a in column_args)
+
+    start = time()
+    # fill_call and call_notify skip calls while mithra.importing is on: fill_call's work is done below for all
+    # calls at once and call_notify is replaced by one summary notification. Foreign keys are still checked.
+    # Call stats wait until the import is committed.
+    await conn.execute("SET LOCAL mithra.importing = 'on'")
+    await conn.execute('SELECT pg_advisory_xact_lock($1)', CALL_STATS_LOCK)
+    await conn.execute("""
+    CREATE TEMPORARY TABLE import_calls (
+      number VARCHAR(127) NOT NULL,
+      country VARCHAR(31),
+      ts VARCHAR(63) NOT NULL
+    ) ON COMMIT DROP
+    """)
+
+    rows = 0
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        missing = {columns['number'], columns['ts']} - set(reader.fieldnames or [])
+        if missing:
+            raise RuntimeError(f'columns missing from CSV: {", ".join(sorted(missing))}')
+        batch = []
+        for row in reader:
+            number = call_number(row[columns['number']], settings.default_country_code)
+            batch.append((number, row.get(columns['country']) or None, row[columns['ts']]))
+            if len(batch) >= IMPORT_BATCH:
+                await conn.copy_records_to_table('import_calls', records=batch, columns=['number', 'country', 'ts'])
+                rows += len(batch)
+                batch = []
+                print(f'{rows} rows loaded...')
+        if batch:
+            await conn.copy_records_to_table('import_calls', records=batch, columns=['number', 'country', 'ts'])
+            rows += len(batch)
+    print(f'{rows} rows loaded in {time() - start:0.2f}s')
+
+    await conn.execute("""
+    SELECT create_calls_partition(month)
+    FROM (SELECT DISTINCT date_trunc('month', ts::TIMESTAMP) AS month FROM import_calls) AS t
+    """)
+    await conn.execute(import_numbers_sql)
+    await conn.execute(import_calls_sql)
+    summary = await conn.fetchrow("""
+    SELECT count(*) AS calls, count(n.person) AS matched, min(i.ts::TIMESTAMP) AS first, max(i.ts::TIMESTAMP) AS last
+    FROM import_calls AS i
+    LEFT JOIN import_numbers AS n ON i.number = n.number
+    """)
+    summary = {k: v.isoformat() if hasattr(v, 'isoformat') else v for k, v in summary.items()}
+    await conn.execute("SELECT pg_notify('calls_imported', $1)", json.dumps(summary))
+    print(f'{summary["calls"]} calls imported, {summary["matched"]} matched to people, '
+          f'from {summary["first"]} to {summary["last"]} in {time() - start:0.2f}s')
+
+
+@chunked_patch
+async def rematch_calls(conn, last_key, chunk_size, **kwargs):
+    """
+    re-run fill_call on calls without a person, in chunks by id.
+    """
+    last_key = last_key or 0
+    max_id = await conn.fetchval('SELECT max(id) FROM (SELECT id FROM calls WHERE id > $1 ORDER BY id LIMIT $2) AS t',
+                                 last_key, chunk_size)
+    if max_id is None:
+        return None, 0
+    r = await conn.execute('UPDATE calls SET id=id WHERE id > $1 AND id <= $2 AND person IS NULL', last_key, max_id)
+    return max_id, int(r.split()[-1])
+
+
+@chunked_patch
+async def renormalise_people_numbers(conn, settings, last_key, chunk_size, **kwargs):
+    """
+    convert people_numbers to E.164 so calls match them exactly, run before renormalise_calls.
+    """
+    people = await conn.fetch("""
+    SELECT person, array_agg(number) AS numbers FROM people_numbers
+    WHERE person > $1 GROUP BY person ORDER BY person LIMIT $2
+    """, last_key or 0, chunk_size)
+    if not people:
+        return None, 0
+    changed = []
+    for person, numbers in people:
+        for number in numbers:
+            new_number = clean_number(number, settings.default_country_code)
+            if new_number != number:
+                changed.append((person, number, new_number))
+    if changed:
+        persons, old_numbers, new_numbers = zip(*changed)
+        await conn.execute("""
+        DELETE FROM people_numbers AS pn
+        USING unnest($1::INT[], $2::VARCHAR[]) AS c(person, number)
+        WHERE pn.person = c.person AND pn.number = c.number
+        """, persons, old_numbers)
+        await conn.execute("""
+        INSERT INTO people_numbers (person, number)
+        SELECT * FROM unnest($1::INT[], $2::VARCHAR[])
+        ON CONFLICT DO NOTHING
+        """, persons, new_numbers)
+    return people[-1]['person'], len(changed)
+
+
+@chunked_patch
+async def renormalise_calls(conn, settings, last_key, chunk_size, **kwargs):
+    """
+    convert numbers in calls to E.164, fill_call re-matches each changed call to a person.
+    """
+    calls = await conn.fetch('SELECT id, number FROM calls WHERE id > $1 ORDER BY id LIMIT $2',
+                             last_key or 0, chunk_size)
+    if not calls:
+        return None, 0
+    changed = []
+    for call_id, number in calls:
+        # calls used to be saved as their digits without the "+", so bare digits are international
+        new_number = call_number(number, settings.default_country_code, international=True)
+        if new_number != number:
+            changed.append((call_id, new_number))
+    if changed:
+        await conn.execute("""
+        UPDATE calls SET number = c.number
+        FROM unnest($1::INT[], $2::VARCHAR[]) AS c(id, number)
+        WHERE calls.id = c.id
+        """, *zip(*changed))
+    return calls[-1]['id'], len(changed)
@@ -8,6 +8,32 @@ BASE_DIR = THIS_DIR.parent
 
 class Settings(PgSettings):
     google_siw_client_key = '421181039733-sdkjn7bclc9qgvk9a6iqrah0v3fk4aa5.apps.googleusercontent.com'
+    # google's sign-in certs, changed to use a local stand-in when testing
+    google_certs_url = 'https://www.googleapis.com/oauth2/v1/certs'
     auth_key = b'R60Wdn84EzcTuP4YQxvAAgiDlyNgl38keTVysTDdr2g='
     intercom_key: str = None
+    intercom_url = 'https://api.intercom.io'
+    # save raw pages from intercom to cache_dir so "download_from_intercom --from-cache" can rebuild without intercom
+    intercom_page_cache: bool = False
     cache_dir: str = '/tmp/mithra'
+    # country code of national numbers, see shared.numbers.canonical_number
+    default_country_code = '44'
+    # months of calls to keep, older monthly partitions are exported to cache_dir/calls_archive then dropped,
+    # None keeps calls forever
+    calls_retention_months: int = None
+    # seconds between websocket pings, unresponsive websockets are closed, 0 to disable
+    ws_heartbeat: float = 20
+    # seconds to wait for a message to be sent to a websocket before closing it
+    ws_send_timeout: float = 5
+    # add times to call_traces as calls are sent to websockets, see WebsocketPropagator
+    trace_calls: bool = True
+    # log the loop thread's stack when the event loop is blocked for longer than this many seconds, 0 to disable
+    loop_lag_threshold: float = 0.5
+    # encoder for json responses: "auto" to use orjson if it's installed, "orjson" or "json"
+    json_encoder = 'auto'
+    # seconds a replica can be behind the primary and still be used by list, search and stats views
+    pg_replica_max_lag: float = 10
+    # seconds a replica can be behind and still be used by detail views which otherwise use the primary
+    pg_replica_detail_max_lag: float = 1
+    # number of web worker processes, more than one means workers share the port with SO_REUSEPORT
+    web_workers: int = 1
@@ -1,32 +1,84 @@
+import asyncio
 import datetime
+import gzip
+import hashlib
 import json
+import logging
+import re
 from decimal import Decimal
+from time import time
 from uuid import UUID
 
-from aiohttp import ClientSession
+from aiohttp import ClientError, ClientSession
 from aiohttp.web import Response
 from aiohttp.web_exceptions import HTTPClientError
 from google.auth import jwt as google_jwt
-from google.oauth2.id_token import _GOOGLE_OAUTH2_CERTS_URL
 
 from .settings import Settings
 
-CERTS = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-async def google_certs():
-    global CERTS
-    if not CERTS:
-        async with ClientSession(conn_timeout=10, read_timeout=10) as session:
-            async with session.get(_GOOGLE_OAUTH2_CERTS_URL) as r:
+logger = logging.getLogger('mithra.web.utils')
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+class GoogleCerts:
+    """
+    Cache of Google's sign-in certificates which expires according to the "max-age" of the response so rotated keys
+    are picked up without a restart. GoogleCertsRefresher fetches them at startup and before they expire so sign-ins
+    normally don't wait for a request, concurrent misses share one request.
+    """
+    # seconds to cache certs for if the response has no "max-age"
+    DEFAULT_MAX_AGE = 3600
+    # seconds before certs expire that GoogleCertsRefresher fetches them again
+    REFRESH_MARGIN = 300
+
+    def __init__(self, url, session: ClientSession):
+        self.url = url
+        self.session = session
+        self.certs = None
+        self.expires = 0
+        self._lock = asyncio.Lock()
+
+    def ttl(self):
+        return self.expires - time()
+
+    async def get(self):
+        if self.certs is None or self.ttl() <= 0:
+            try:
+                await self.refresh()
+            except (ClientError, asyncio.TimeoutError, AssertionError) as e:
+                if self.certs is None:
+                    raise
+                # keys overlap when google rotates them, so the old certs are still better than failing every sign-in
+                logger.warning('error refreshing google certs, using expired certs: %s: %s', e.__class__.__name__, e)
+        return self.certs
+
+    async def refresh(self):
+        expires = self.expires
+        async with self._lock:
+            if self.expires != expires:
+                # another request refreshed the certs while we were waiting
+                return
+            async with self.session.get(self.url) as r:
                 assert r.status == 200, r.status
-                CERTS = await r.json()
-    return CERTS
+                certs = await r.json()
+            m = MAX_AGE.search(r.headers.get('Cache-Control', ''))
+            self.certs = certs
+            self.expires = time() + (int(m.group(1)) if m else self.DEFAULT_MAX_AGE)
+            logger.info('google certs refreshed, %d keys, expire in %0.0fs', len(certs), self.ttl())
 
 
-async def google_get_details(settings: Settings, id_token):
-    certs = await google_certs()
-    id_info = google_jwt.decode(id_token, certs=certs, audience=settings.google_siw_client_key)
+async def google_get_details(settings: Settings, certs: GoogleCerts, id_token):
+    id_info = google_jwt.decode(id_token, certs=await certs.get(), audience=settings.google_siw_client_key)
 
     # this should happen very rarely, if it does someone is doing something nefarious or things have gone very wrong
     assert id_info['iss'] in {'accounts.google.com', 'https://accounts.google.com'}, 'wrong google iss'
@@ -42,6 +94,16 @@ async def google_get_details(settings: Settings, id_token):
 
 
 JSON_CONTENT_TYPE = 'application/json'
+# bodies smaller than this aren't worth compressing
+COMPRESS_MIN_SIZE = 1024
+# fast levels for responses compressed on every request, Precompressed bodies use the best compression
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+# list views and call stats return the same body until the data changes, so compressed bodies are cached by
+# encoding and digest of the body, see compress_cached. Larger bodies aren't cached to limit memory use.
+COMPRESSED_CACHE_SIZE = 200
+COMPRESSED_CACHE_MAX_BODY = 1024 ** 2
+_compressed_cache = {}
 
 
 def isoformat(o):
@@ -68,33 +130,135 @@ class UniversalEncoder(json.JSONEncoder):
         return encoder(obj)
 
 
+def _lenient_default(obj):
+    try:
+        encoder = UniversalEncoder.ENCODER_BY_TYPE[type(obj)]
+    except KeyError:
+        raise TypeError(f'Object of type {obj.__class__.__name__} is not JSON serializable')
+    return encoder(obj)
+
+
+def _json_dumps(data):
+    return json.dumps(data, cls=UniversalEncoder, separators=(',', ':')).encode()
+
+
+def _orjson_dumps(data):
+    return orjson.dumps(data, default=_lenient_default)
+
+
+JSON_ENCODERS = {
+    'json': _json_dumps,
+    'orjson': _orjson_dumps,
+}
+# compact, lenient json encoder returning bytes, see set_json_encoder
+dumps = _json_dumps
+
+
+def set_json_encoder(name):
+    """
+    Choose the encoder used by dumps: "json" for the standard library, "orjson" or "auto" for orjson if it's
+    installed, otherwise json.
+    """
+    global dumps
+    if name == 'auto':
+        name = 'orjson' if orjson else 'json'
+    elif name not in JSON_ENCODERS:
+        raise ValueError(f'unknown json encoder "{name}", options are "auto", {", ".join(JSON_ENCODERS)}')
+    elif name == 'orjson' and not orjson:
+        raise RuntimeError('json encoder "orjson" selected but orjson is not installed')
+    dumps = JSON_ENCODERS[name]
+
+
 def pretty_lenient_json(data):
     return json.dumps(data, indent=2, cls=UniversalEncoder) + '\n'
 
 
-def pretty_json(data):
-    return json.dumps(data, indent=2) + '\n'
+def accepted_encoding(request):
+    """
+    Best content coding the client accepts: "br" if brotli is installed, then "gzip", otherwise None.
+    """
+    accepted = set()
+    for item in request.headers.get('Accept-Encoding', '').lower().split(','):
+        coding, _, params = item.partition(';')
+        name, _, q = params.partition('=')
+        try:
+            if name.strip() == 'q' and float(q) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip())
+    if brotli and 'br' in accepted:
+        return 'br'
+    elif 'gzip' in accepted:
+        return 'gzip'
+
+
+def compress(body: bytes, encoding, best=False):
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if best else BROTLI_QUALITY)
+    else:
+        return gzip.compress(body, compresslevel=9 if best else GZIP_LEVEL)
+
+
+def compress_cached(body: bytes, encoding):
+    global _compressed_cache
+    if len(body) > COMPRESSED_CACHE_MAX_BODY:
+        return compress(body, encoding)
+    key = encoding, hashlib.sha1(body).digest()
+    compressed = _compressed_cache.pop(key, None)
+    if compressed is None:
+        compressed = compress(body, encoding)
+        # very simple lru cache, once full cut to the most recently used half
+        if len(_compressed_cache) >= COMPRESSED_CACHE_SIZE:
+            _compressed_cache = dict(list(_compressed_cache.items())[-(COMPRESSED_CACHE_SIZE // 2):])
+    _compressed_cache[key] = compressed
+    return compressed
+
+
+def compressed_response(request, body: bytes, *, status=200, content_type=JSON_CONTENT_TYPE):
+    headers = {'Vary': 'Accept-Encoding'}
+    encoding = len(body) >= COMPRESS_MIN_SIZE and accepted_encoding(request)
+    if encoding:
+        body = compress_cached(body, encoding)
+        headers['Content-Encoding'] = encoding
+    return Response(body=body, status=status, content_type=content_type, headers=headers)
+
 
+class Precompressed:
+    """
+    Body which doesn't change while the app is running, eg. index.html, compressed once with every available
+    encoding at the best level.
+    """
+    def __init__(self, body: bytes, content_type, charset=None):
+        self.content_type = content_type
+        self.charset = charset
+        self.variants = {None: body, 'gzip': compress(body, 'gzip', best=True)}
+        if brotli:
+            self.variants['br'] = compress(body, 'br', best=True)
 
-def raw_json_response(json_str, status_=200):
-    return Response(
-        body=json_str.encode() + b'\n',
-        status=status_,
-        content_type=JSON_CONTENT_TYPE,
-    )
+    def response(self, request):
+        encoding = accepted_encoding(request)
+        headers = {'Vary': 'Accept-Encoding'}
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return Response(body=self.variants[encoding], content_type=self.content_type, charset=self.charset,
+                        headers=headers)
+
+
+def raw_json_response(request, json_str, status_=200):
+    """
+    Response from JSON generated by postgres, sent as is rather than copied to add a trailing newline.
+    """
+    return compressed_response(request, json_str.encode(), status=status_)
 
 
 def json_response(request, *, status_=200, list_=None, **data):
-    if JSON_CONTENT_TYPE in request.headers.get('Accept', ''):
-        to_json = json.dumps
+    data = data if list_ is None else list_
+    if 'pretty' in request.query:
+        body = pretty_lenient_json(data).encode()
     else:
-        to_json = pretty_json
-
-    return Response(
-        body=to_json(data if list_ is None else list_).encode(),
-        status=status_,
-        content_type=JSON_CONTENT_TYPE,
-    )
+        body = dumps(data)
+    return compressed_response(request, body, status=status_)
 
 
 class JsonErrors:
@@ -1,9 +1,12 @@
+import asyncio
 import logging
+import os
 from asyncio import CancelledError
+from datetime import datetime, timedelta
 from time import time
 
 from aiohttp import WSMsgType
-from aiohttp.web import Response
+from aiohttp.web import StreamResponse
 from aiohttp.web_ws import WebSocketResponse
 from aiohttp_session import get_session
 
@@ -13,14 +16,33 @@ logger = logging.getLogger('mithra.web')
 TWO_WEEKS = 3600 * 24 * 7 * 2
 
 
+def read_pg(request, details=False):
+    """
+    Pool for read-only queries: a read replica which is up to date enough or otherwise the primary. Writes and
+    anything which has to be consistent with notifications (eg. the calls sent to websockets) use app['pg'].
+    """
+    settings = request.app['settings']
+    max_lag = settings.pg_replica_detail_max_lag if details else settings.pg_replica_max_lag
+    return request.app['replica_monitor'].pool(max_lag)
+
+
+async def fetch_details(request, sql, *args):
+    pg = read_pg(request, details=True)
+    json_str = await pg.fetchval(sql, *args)
+    if json_str is None and pg is not request.app['pg']:
+        # eg. a call or person which hasn't reached the replica yet
+        json_str = await request.app['pg'].fetchval(sql, *args)
+    return json_str
+
+
 async def index(request):
-    return Response(text=request.app['index_html'], content_type='text/html')
+    return request.app['index_html'].response(request)
 
 
 async def signin_with_google(request):
     data = await request.json()
     try:
-        details = await google_get_details(request.app['settings'], data['id_token'])
+        details = await google_get_details(request.app['settings'], request.app['google_certs'], data['id_token'])
     except (KeyError, ValueError) as e:
         logger.exception('error parsing google sso token: %s', e)
         raise JsonErrors.HTTPBadRequest(text='invalid token')
@@ -40,21 +62,76 @@ async def signout(request):
 
 
 calls_sql = """
-SELECT array_to_json(array_agg(row_to_json(t)), TRUE)
+SELECT array_to_json(array_agg(row_to_json(t)))
 FROM (
   SELECT c.id AS id, c.number AS number, c.country AS country, c.ts AS ts,
   p.name AS person_name, co.name AS company, co.has_support AS has_support
-  FROM calls AS c
+  -- limit before joining so only the newest entries of each partition's ts index are read
+  FROM (SELECT * FROM calls WHERE {filter} ORDER BY ts DESC LIMIT 100) AS c
+  LEFT JOIN people AS p ON c.person = p.id
+  LEFT JOIN companies AS co ON p.company = co.id
+  ORDER BY c.ts DESC
+) t;
+"""
+
+# calls a resuming client doesn't have, up to RESUME_MAX + 1 to tell if the gap is too big to fill
+missed_calls_sql = """
+SELECT EXISTS (SELECT 1 FROM calls WHERE id = $1), array_to_json(array_agg(row_to_json(t))), count(*)
+FROM (
+  SELECT c.id AS id, c.number AS number, c.country AS country, c.ts AS ts,
+  p.name AS person_name, co.name AS company, co.has_support AS has_support
+  FROM (SELECT * FROM calls WHERE id > $1 AND {filter} ORDER BY id LIMIT $2) AS c
   LEFT JOIN people AS p ON c.person = p.id
   LEFT JOIN companies AS co ON p.company = co.id
   ORDER BY c.ts DESC
-  LIMIT 100
 ) t;
 """
+RESUME_MAX = 100
+# limits calls to a websocket's subscription, see ws_subscription
+calls_filter_sql = """
+(${brands}::VARCHAR(31)[] IS NULL OR country = ANY(${brands})) AND
+(NOT ${support_only} OR person IN (
+  SELECT p.id FROM people AS p JOIN companies AS co ON p.company = co.id WHERE co.has_support
+))
+"""
+calls_sql = calls_sql.format(filter=calls_filter_sql.strip().format(brands=1, support_only=2))
+missed_calls_sql = missed_calls_sql.format(filter=calls_filter_sql.strip().format(brands=3, support_only=4))
+
+
+def ws_subscription(request):
+    """
+    Calls a websocket wants from the query string: "brand" (may be repeated) limits calls to those brands,
+    "support=1" limits calls to companies with support. Returns (brands or None for all, support_only)
+    """
+    brands = request.query.getall('brand', None)
+    return brands or None, request.query.get('support') in {'1', 'true'}
+
+
+async def initial_calls(request, brands, support_only):
+    """
+    Calls to send a newly connected websocket: if the client gives the id of the last call it has with "last_id"
+    and there have been no more than RESUME_MAX calls since, just the missed calls as {"missed": [...]} otherwise
+    the full list of recent calls.
+    """
+    try:
+        last_id = int(request.query['last_id'])
+    except (KeyError, ValueError):
+        pass
+    else:
+        # last_id won't exist if the database has been reset or the call has been archived
+        exists, json_str, count = await request.app['pg'].fetchrow(
+            missed_calls_sql, last_id, RESUME_MAX + 1, brands, support_only
+        )
+        if exists and count <= RESUME_MAX:
+            return '{"missed": %s}' % (json_str or '[]')
+
+    json_str = await request.app['pg'].fetchval(calls_sql, brands, support_only)
+    return json_str or '[]'
 
 
 async def main_ws(request):
-    ws = WebSocketResponse()
+    # aiohttp pings every "heartbeat" seconds and closes the connection if there's no pong within half that
+    ws = WebSocketResponse(heartbeat=request.app['settings'].ws_heartbeat or None)
 
     session = await get_session(request)
     expires = session.get('expires', 0)
@@ -65,9 +142,9 @@ async def main_ws(request):
 
     user = '{first_name} {last_name} ({email})'.format(**session['user']).strip(' ')
     logger.info('ws connection from %s', user)
-    json_str = await request.app['pg'].fetchval(calls_sql)
-    await ws.send_str(json_str or '[]')
-    request.app['ws_propagator'].add_ws(ws)
+    brands, support_only = ws_subscription(request)
+    await ws.send_str(await initial_calls(request, brands, support_only))
+    request.app['ws_propagator'].add_ws(ws, brands, support_only)
     try:
         async for msg in ws:
             logger.info('ws message:', msg)
@@ -76,13 +153,37 @@ async def main_ws(request):
     except CancelledError:
         pass
     finally:
-        request.app['ws_propagator'].remove_ws(ws)
+        propagator = request.app['ws_propagator']
+        # the websocket may already have been removed by the propagator after a failed send
+        if ws in propagator.websockets and isinstance(ws.exception(), asyncio.TimeoutError):
+            propagator.reap(ws, 'heartbeat_timeout')
+        else:
+            propagator.remove_ws(ws)
         logger.info('websocket disconnected: %s', user)
     return ws
 
 
+async def status(request):
+    """
+    Status of this web process: websocket connections, read replica lag in seconds and event loop lag.
+    """
+    propagator = request.app['ws_propagator']
+    return json_response(
+        request,
+        pid=os.getpid(),
+        websockets=dict(
+            connected=len(propagator.websockets),
+            support_only=len(propagator.support_only),
+            subscriptions={str(brand): len(ws) for brand, ws in propagator.subscriptions.items()},
+            reaped=propagator.reaped,
+        ),
+        replica_lags=list(request.app['replica_monitor'].lags.values()),
+        loop_lag=request.app['loop_monitor'].status(),
+    )
+
+
 people_sql = """
-SELECT array_to_json(array_agg(row_to_json(t)), TRUE)
+SELECT array_to_json(array_agg(row_to_json(t)))
 FROM (
   SELECT p.id AS id, p.name AS name, p.last_seen AS last_seen,
   co.name AS company_name, co.id as company_id, co.has_support AS has_support
@@ -95,13 +196,13 @@ FROM (
 
 
 async def people(request):
-    json_str = await request.app['pg'].fetchval(people_sql)
+    json_str = await read_pg(request).fetchval(people_sql)
     # return as dict in case we want to add count etc. later
-    return raw_json_response('{"items": %s}' % (json_str or '[]'))
+    return raw_json_response(request, '{"items": %s}' % (json_str or '[]'))
 
 
 companies_sql = """
-SELECT array_to_json(array_agg(row_to_json(t)), TRUE)
+SELECT array_to_json(array_agg(row_to_json(t)))
 FROM (
   SELECT id, name, login_url, created, has_support
   FROM companies
@@ -112,9 +213,9 @@ FROM (
 
 
 async def companies(request):
-    json_str = await request.app['pg'].fetchval(companies_sql)
+    json_str = await read_pg(request).fetchval(companies_sql)
     # return as dict in case we want to add count etc. later
-    return raw_json_response('{"items": %s}' % (json_str or '[]'))
+    return raw_json_response(request, '{"items": %s}' % (json_str or '[]'))
 
 
 call_details_sql = """
@@ -132,8 +233,8 @@ FROM (
 
 
 async def call_details(request):
-    json_str = await request.app['pg'].fetchval(call_details_sql, int(request.match_info['id']))
-    return raw_json_response(json_str or 'null')
+    json_str = await fetch_details(request, call_details_sql, int(request.match_info['id']))
+    return raw_json_response(request, json_str or 'null')
 
 
 person_details_sql = """
@@ -149,7 +250,7 @@ FROM (
 ) t;
 """
 person_calls_sql = """
-SELECT array_to_json(array_agg(row_to_json(t)), TRUE)
+SELECT array_to_json(array_agg(row_to_json(t)))
 FROM (
   SELECT number, country, ts
   FROM calls
@@ -162,11 +263,11 @@ FROM (
 
 async def person_details(request):
     id = int(request.match_info['id'])
-    json_str = await request.app['pg'].fetchval(person_details_sql, id)
+    json_str = await fetch_details(request, person_details_sql, id)
     if json_str:
-        calls_json_str = await request.app['pg'].fetchval(person_calls_sql, id)
+        calls_json_str = await read_pg(request, details=True).fetchval(person_calls_sql, id)
         json_str = json_str[:-1] + ', "calls": %s}' % (calls_json_str or '[]')
-    return raw_json_response(json_str or 'null')
+    return raw_json_response(request, json_str or 'null')
 
 
 company_details_sql = """
@@ -176,7 +277,7 @@ FROM (
 ) t;
 """
 company_people_sql = """
-SELECT array_to_json(array_agg(row_to_json(t)), TRUE)
+SELECT array_to_json(array_agg(row_to_json(t)))
 FROM (
   SELECT p.id AS id, p.name AS name, p.last_seen AS last_seen, array_agg(pn.number) AS numbers
   FROM people AS p
@@ -192,15 +293,15 @@ FROM (
 
 async def company_details(request):
     co_id = int(request.match_info['id'])
-    json_str = await request.app['pg'].fetchval(company_details_sql, co_id)
+    json_str = await fetch_details(request, company_details_sql, co_id)
     if json_str:
-        people_json_str = await request.app['pg'].fetchval(company_people_sql, co_id)
+        people_json_str = await read_pg(request, details=True).fetchval(company_people_sql, co_id)
         json_str = json_str[:-1] + ', "people": %s}' % (people_json_str or '[]')
-    return raw_json_response(json_str or 'null')
+    return raw_json_response(request, json_str or 'null')
 
 
 people_search_sql = """
-SELECT array_to_json(array_agg(row_to_json(t)), TRUE)
+SELECT array_to_json(array_agg(row_to_json(t)))
 FROM (
   SELECT p.id AS id, p.name AS name, p.last_seen AS last_seen,
   co.name AS company_name, co.id AS company_id,
@@ -223,5 +324,211 @@ async def search(request):
     query = request.query.get('q')
     json_str = None
     if query and len(query) >= 2:
-        json_str = await request.app['pg'].fetchval(people_search_sql, query, f'%{query}%')
-    return raw_json_response(json_str or '[]')
+        json_str = await read_pg(request).fetchval(people_search_sql, query, f'%{query}%')
+    return raw_json_response(request, json_str or '[]')
+
+
+# period -> (period of call_stats rows to use, default range, maximum range)
+STATS_PERIODS = {
+    'hour': ('hour', timedelta(days=2), timedelta(days=31)),
+    'day': ('day', timedelta(days=60), timedelta(days=3 * 366)),
+    'month': ('day', timedelta(days=2 * 366), timedelta(days=20 * 366)),
+}
+STATS_GROUPS = {
+    'company': ('s.company AS company, co.name AS company_name,', ', s.company, co.name'),
+    'country': ('s.country AS country,', ', s.country'),
+}
+call_stats_sql = """
+SELECT array_to_json(array_agg(row_to_json(t)))
+FROM (
+  SELECT date_trunc($1, s.bucket) AS bucket, {select}
+  sum(s.calls) AS calls, sum(s.matched) AS matched
+  FROM call_stats AS s
+  LEFT JOIN companies AS co ON s.company = co.id
+  WHERE s.period = $2 AND s.bucket >= $3 AND s.bucket < $4 {where}
+  GROUP BY 1 {group_by}
+  ORDER BY 1 {group_by}
+) t;
+"""
+
+
+def parse_ts(request, name, default=None):
+    value = request.query.get(name)
+    if not value:
+        return default
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise JsonErrors.HTTPBadRequest(text=f'invalid "{name}", should be in the format YYYY-MM-DD[THH:MM[:SS]]')
+
+
+async def call_stats(request):
+    """
+    Call counts from call_stats, "period" is hour, day or month, "from" and "to" limit the range, "company" and
+    "country" filter by company id and country and "by" splits counts by company or country.
+    """
+    period = request.query.get('period', 'day')
+    by = request.query.get('by')
+    if period not in STATS_PERIODS:
+        raise JsonErrors.HTTPBadRequest(text=f'invalid "period", options are: {", ".join(STATS_PERIODS)}')
+    if by and by not in STATS_GROUPS:
+        raise JsonErrors.HTTPBadRequest(text=f'invalid "by", options are: {", ".join(STATS_GROUPS)}')
+
+    stats_period, default_range, max_range = STATS_PERIODS[period]
+    to = parse_ts(request, 'to', datetime.utcnow())
+    from_ = parse_ts(request, 'from', to - default_range)
+    if to - from_ > max_range:
+        raise JsonErrors.HTTPBadRequest(text=f'range too large, the maximum for "{period}" is {max_range.days} days')
+
+    args = [period, stats_period, from_, to]
+    where = ''
+    if request.query.get('company'):
+        try:
+            args.append(int(request.query['company']))
+        except ValueError:
+            raise JsonErrors.HTTPBadRequest(text='invalid "company"')
+        where += f' AND s.company = ${len(args)}'
+    if 'country' in request.query:
+        args.append(request.query['country'])
+        where += f' AND s.country = ${len(args)}'
+
+    select, group_by = STATS_GROUPS[by] if by else ('', '')
+    sql = call_stats_sql.format(select=select, where=where, group_by=group_by)
+    json_str = await read_pg(request).fetchval(sql, *args)
+    return raw_json_response(request, '{"period": "%s", "items": %s}' % (period, json_str or '[]'))
+
+
+EXPORTS = {
+    'calls': {
+        'sql': (
+            'SELECT c.id, c.number, c.country, c.ts, p.id AS person_id, p.name AS person_name, '
+            'co.id AS company_id, co.name AS company_name '
+            'FROM calls AS c '
+            'LEFT JOIN people AS p ON c.person = p.id '
+            'LEFT JOIN companies AS co ON p.company = co.id'
+        ),
+        'ts': 'c.ts',
+        'company': 'co.id',
+        'order': 'c.ts',
+    },
+    'people': {
+        'sql': (
+            'SELECT p.id, p.name, p.last_seen, co.id AS company_id, co.name AS company_name, '
+            '(SELECT array_agg(pn.number) FROM people_numbers AS pn WHERE pn.person = p.id) AS numbers '
+            'FROM people AS p '
+            'JOIN companies AS co ON p.company = co.id'
+        ),
+        'ts': 'p.last_seen',
+        'company': 'co.id',
+        'order': 'p.id',
+    },
+    'companies': {
+        'sql': 'SELECT co.id, co.name, co.ic_id, co.created, co.login_url, co.has_support FROM companies AS co',
+        'ts': 'co.created',
+        'company': 'co.id',
+        'order': 'co.id',
+    },
+}
+EXPORT_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+# rows fetched from the cursor and written to the response at a time
+EXPORT_CHUNK = 1000
+
+
+def export_query(request, export):
+    where, args = [], []
+    from_, to = parse_ts(request, 'from'), parse_ts(request, 'to')
+    if from_:
+        args.append(from_)
+        where.append(f'{export["ts"]} >= ${len(args)}')
+    if to:
+        args.append(to)
+        where.append(f'{export["ts"]} < ${len(args)}')
+    if request.query.get('company'):
+        try:
+            args.append(int(request.query['company']))
+        except ValueError:
+            raise JsonErrors.HTTPBadRequest(text='invalid "company"')
+        where.append(f'{export["company"]} = ${len(args)}')
+
+    sql = export['sql']
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    return f'{sql} ORDER BY {export["order"]}', args
+
+
+async def export(request):
+    """
+    Stream all calls, people or companies as NDJSON or CSV ("format"), filtered by "from", "to" and "company".
+
+    CSV is generated by postgres with COPY, NDJSON rows are built by postgres and read from a cursor in chunks,
+    either way only one chunk is in memory at a time.
+    """
+    kind = request.match_info['kind']
+    fmt = request.query.get('format', 'ndjson')
+    if fmt not in EXPORT_CONTENT_TYPES:
+        raise JsonErrors.HTTPBadRequest(text=f'invalid "format", options are: {", ".join(EXPORT_CONTENT_TYPES)}')
+    sql, args = export_query(request, EXPORTS[kind])
+
+    response = StreamResponse(headers={'Content-Disposition': f'attachment; filename="{kind}.{fmt}"'})
+    response.content_type = EXPORT_CONTENT_TYPES[fmt]
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    async with read_pg(request).acquire() as conn:
+        if fmt == 'csv':
+            await conn.copy_from_query(sql, *args, output=response.write, format='csv', header=True)
+        else:
+            async with conn.transaction():
+                chunk = []
+                cursor = conn.cursor(f'SELECT row_to_json(t)::text FROM ({sql}) t', *args, prefetch=EXPORT_CHUNK)
+                async for row in cursor:
+                    chunk.append(row[0])
+                    if len(chunk) >= EXPORT_CHUNK:
+                        await response.write('\n'.join(chunk).encode() + b'\n')
+                        chunk = []
+                if chunk:
+                    await response.write('\n'.join(chunk).encode() + b'\n')
+    await response.write_eof()
+    return response
+
+
+# name and time taken by each hop in call_traces
+TRACE_HOPS = [
+    ('parsed', 'parsed'),
+    ('dedup', 'dedup - parsed'),
+    ('db_start', 'db_start - dedup'),
+    ('notified', 'notified - db_start'),
+    ('propagated', 'propagated - notified'),
+    ('sent', 'sent - propagated'),
+    ('total', 'sent'),
+]
+TRACE_PERCENTILES = 0.5, 0.95, 0.99
+call_latency_sql = """
+SELECT count(*) AS calls, {hops}
+FROM call_traces
+WHERE received > CURRENT_TIMESTAMP - $1::INT * interval '1 hour' AND sent IS NOT NULL
+""".format(hops=', '.join(
+    f'percentile_cont(ARRAY{list(TRACE_PERCENTILES)}) WITHIN GROUP (ORDER BY {expr}) AS {name}'
+    for name, expr in TRACE_HOPS
+))
+
+
+async def call_latency(request):
+    """
+    Percentiles of the time in ms each hop took for calls in the last "hours" (default 24) from call_traces,
+    "total" is from the backend receiving the INVITE to the call being sent to the last websocket.
+    """
+    try:
+        hours = int(request.query.get('hours', 24))
+    except ValueError:
+        raise JsonErrors.HTTPBadRequest(text='invalid "hours"')
+    r = await read_pg(request).fetchrow(call_latency_sql, hours)
+    hops = {}
+    for hop, _ in TRACE_HOPS:
+        values = r[hop] or [None] * len(TRACE_PERCENTILES)
+        hops[hop] = {f'p{p * 100:0.0f}': v and round(v / 1000, 3) for p, v in zip(TRACE_PERCENTILES, values)}
+    return json_response(request, hours=hours, calls=r['calls'], hops=hops)
@@ -0,0 +1,114 @@
+import logging
+import os
+import signal
+import time
+
+logger = logging.getLogger('mithra.web.workers')
+
+
+class Supervisor:
+    """
+    Fork and supervise web worker processes which all bind the same port with SO_REUSEPORT so the kernel
+    balances connections between them.
+
+    * workers which die unexpectedly are restarted
+    * SIGHUP does a rolling restart: each worker is replaced by a new one before being sent SIGTERM
+    * SIGTERM or SIGINT stops all workers and exits once they've finished
+
+    worker_func is called with the worker number in each child process, it should serve until it gets SIGTERM.
+    It must create its own event loop, so nothing should create one in the supervisor before forking.
+    """
+    # seconds a new worker gets to start up during a rolling restart before the worker it replaces is stopped
+    RESTART_DELAY = 2
+    # seconds to wait before restarting a worker which died unexpectedly
+    CRASH_DELAY = 1
+
+    def __init__(self, worker_func, workers: int):
+        self.worker_func = worker_func
+        self.workers = workers
+        # pid -> worker number
+        self.children = {}
+        # pids of workers which have been told to stop and shouldn't be replaced
+        self.retiring = set()
+        self.stopping = None
+        self.restart_requested = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_restart)
+        logger.info('supervisor pid %d starting %d workers', os.getpid(), self.workers)
+        for number in range(self.workers):
+            self.spawn(number)
+
+        while self.children:
+            if self.restart_requested:
+                self.restart_requested = False
+                self.rolling_restart()
+            self.reap()
+            time.sleep(0.2)
+        logger.info('all workers stopped, reason: %s', self.stopping)
+
+    def spawn(self, number):
+        pid = os.fork()
+        if pid == 0:
+            for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(sig, signal.SIG_DFL)
+            exit_code = 0
+            try:
+                self.worker_func(number)
+            except BaseException as e:
+                logger.exception('worker %d failed: %s: %s', number, e.__class__.__name__, e)
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        self.children[pid] = number
+        logger.info('started worker %d, pid %d', number, pid)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            number = self.children.pop(pid, None)
+            if number is None:
+                continue
+            exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            if pid in self.retiring or self.stopping:
+                self.retiring.discard(pid)
+                logger.info('worker %d (pid %d) stopped, exit code %d', number, pid, exit_code)
+            else:
+                logger.warning('worker %d (pid %d) died unexpectedly, exit code %d, restarting', number, pid, exit_code)
+                time.sleep(self.CRASH_DELAY)
+                self.spawn(number)
+
+    def rolling_restart(self):
+        logger.info('rolling restart of %d workers', len(self.children))
+        for pid, number in list(self.children.items()):
+            if self.stopping:
+                return
+            self.spawn(number)
+            time.sleep(self.RESTART_DELAY)
+            self.retiring.add(pid)
+            self.kill(pid)
+            self.reap()
+
+    def kill(self, pid, sig=signal.SIGTERM):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def handle_stop(self, signum, frame):
+        if not self.stopping:
+            self.stopping = signal.Signals(signum).name
+            logger.info('%s received, stopping workers', self.stopping)
+            for pid in self.children:
+                self.kill(pid)
+
+    def handle_restart(self, signum, frame):
+        self.restart_requested = True
@@ -1,79 +1,133 @@
 #!/usr/bin/env python3.6
-import asyncio
-import logging.config
+import importlib
+import socket
 import sys
+from collections import namedtuple
 from pathlib import Path
 
-import uvloop
-from aiohttp import ClientSession, web
-
 THIS_DIR = Path(__file__).parent
 if not Path(THIS_DIR / 'shared').exists():
     # when running outside docker
     sys.path.append(str(THIS_DIR / '..'))
 
-from shared.logs import setup_logging  # NOQA
-from app.main import create_app  # NOQA
-from app.patch import reset_database, run_patch  # NOQA
-from app.settings import Settings  # NOQA
-from app.background import download_from_intercom as _download_from_intercom  # NOQA
+
+Command = namedtuple('Command', 'func modules')
+commands = {}
+
+
+def command(*modules):
+    """
+    Register a command, modules are imported only when the command is run and should be everything it needs
+    beyond the standard library, see bench/import_time.py.
+    """
+    def dec(func):
+        commands[func.__name__] = Command(func, modules)
+        return func
+    return dec
 
 
-logger = logging.getLogger('mithra.web.run')
+def setup():
+    import asyncio
+    import uvloop
+    from shared.logs import setup_logging
+    from app.settings import Settings
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    setup_logging()
+    return Settings()
 
 
-async def _check(url):
+@command()
+def check(args):
+    # only uses the standard library unless the check fails so the frequent health check is quick
+    url = 'http://127.0.0.1:8000/api/'
     try:
-        async with ClientSession() as session:
-            async with session.get(url) as r:
-                assert r.status == 200, f'response error {r.status} != 200'
-    except (ValueError, AssertionError, OSError) as e:
-        logger.error('web check error: %s: %s, url: "%s"', e.__class__.__name__, e, url)
-        return 1
+        with socket.create_connection(('127.0.0.1', 8000), timeout=5) as sock:
+            sock.sendall(b'GET /api/ HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n')
+            status = int(sock.makefile('rb').readline().split()[1])
+        assert status == 200, f'response error {status} != 200'
+    except (ValueError, IndexError, AssertionError, OSError) as e:
+        import logging
+        from shared.logs import setup_logging
+        setup_logging()
+        logging.getLogger('mithra.web.run').error('web check error: %s: %s, url: "%s"', e.__class__.__name__, e, url)
+        sys.exit(1)
     else:
-        logger.info('web check successful')
+        print('web check successful')
 
 
-def check():
-    loop = asyncio.get_event_loop()
-    exit_code = loop.run_until_complete(_check('http://127.0.0.1:8000/api/'))
-    if exit_code:
-        exit(exit_code)
+@command('uvloop', 'shared.logs', 'app.settings', 'app.patch')
+def reset_database(args):
+    from app.patch import reset_database as _reset_database
+
+    settings = setup()
+    print('running reset_database...')
+    _reset_database(settings)
+
+
+@command('uvloop', 'shared.logs', 'app.settings', 'app.patch')
+def patch(args):
+    from app.patch import run_patch
+
+    settings = setup()
+    print('running patch...')
+    live = '--live' in args
+    if live:
+        args.remove('--live')
+    run_patch(settings, live, args[0] if args else None, args[1:])
+
 
+@command('uvloop', 'shared.logs', 'app.settings', 'app.background')
+def download_from_intercom(args):
+    import asyncio
+    from app.background import download_from_intercom as _download_from_intercom
 
-def download_from_intercom(settings, force=False):
+    settings = setup()
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(_download_from_intercom(settings, force))
+    loop.run_until_complete(_download_from_intercom(settings, '--force' in args, '--from-cache' in args))
+
+
+@command('uvloop', 'shared.logs', 'app.settings', 'aiohttp.web', 'app.main', 'app.workers')
+def web(args):
+    from aiohttp import web as aiohttp_web
+    from app.main import create_app
+    from app.workers import Supervisor
+
+    settings = setup()
+    workers = settings.web_workers
+    if '--workers' in args:
+        try:
+            workers = int(args[args.index('--workers') + 1])
+            assert workers > 0
+        except (IndexError, ValueError, AssertionError):
+            print('usage: run.py web [--workers <number of workers, at least 1>]')
+            sys.exit(1)
+    print(f'running web server with {workers} worker(s)...')
+
+    def run_worker(number):
+        app = create_app(settings=settings)
+        aiohttp_web.run_app(app, port=8000, shutdown_timeout=1, access_log=None, print=lambda *args: None,
+                            reuse_port=workers > 1)
+
+    if workers > 1:
+        Supervisor(run_worker, workers).run()
+    else:
+        run_worker(0)
 
 
 if __name__ == '__main__':
-    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
-    setup_logging()
-    settings = Settings()
     try:
-        _, command, *args = sys.argv
+        _, command_name, *args = sys.argv
     except ValueError:
-        print('no command provided, options are: "check", "reset_database", "patch", "download_from_intercom" or "web"')
+        print('no command provided, options are: {}'.format(', '.join(f'"{c}"' for c in commands)))
         sys.exit(1)
 
-    if command == 'check':
-        print('running check...')
-        check()
-    elif command == 'reset_database':
-        print('running reset_database...')
-        reset_database(settings)
-    elif command == 'patch':
-        print('running patch...')
-        live = '--live' in args
-        if live:
-            args.remove('--live')
-        run_patch(settings, live, args[0] if args else None)
-    elif command == 'download_from_intercom':
-        download_from_intercom(settings, '--force' in args)
-    elif command == 'web':
-        print('running web server...')
-        app = create_app(settings=settings)
-        web.run_app(app, port=8000, shutdown_timeout=1, access_log=None, print=lambda *args: None)
-    else:
-        print(f'unknown command "{command}"')
+    try:
+        cmd = commands[command_name]
+    except KeyError:
+        print(f'unknown command "{command_name}"')
         sys.exit(1)
+
+    for module in cmd.modules:
+        importlib.import_module(module)
+    cmd.func(args)
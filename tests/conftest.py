@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+
+SRC_DIR = Path(__file__).parent.parent / 'src'
+
+# "shared" and the web "app" are imported from the source tree as they are when running in docker
+for p in (SRC_DIR, SRC_DIR / 'web'):
+    if str(p) not in sys.path:
+        sys.path.append(str(p))
@@ -0,0 +1,48 @@
+"""
+Keep the import time of each command in src/web/run.py within its budget in bench/import_time.py.
+
+Each case starts several interpreters and depends on the machine's load, so they only run when IMPORT_TIME_TESTS
+is set, eg. "IMPORT_TIME_TESTS=1 pytest tests/test_import_time.py", "make import-time" gives the same numbers.
+"""
+import importlib.util
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+BENCH_DIR = Path(__file__).parent.parent / 'bench'
+
+pytestmark = pytest.mark.skipif(not os.getenv('IMPORT_TIME_TESTS'), reason='slow, set IMPORT_TIME_TESTS to run')
+
+
+def load_import_time():
+    spec = importlib.util.spec_from_file_location('import_time', str(BENCH_DIR / 'import_time.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+import_time = load_import_time()
+
+
+@pytest.fixture(scope='module')
+def web_run():
+    # src/web/run.py adds to sys.path when run outside docker, that shouldn't leak into other tests
+    sys_path = sys.path[:]
+    try:
+        return import_time.load_web_run()
+    finally:
+        sys.path[:] = sys_path
+
+
+@pytest.fixture(scope='module')
+def startup():
+    return import_time.time_code('pass', 5)
+
+
+@pytest.mark.parametrize('name', sorted(import_time.BUDGETS))
+def test_import_time(name, web_run, startup):
+    ms = import_time.command_import_time(web_run.commands[name], startup, 5)
+    budget = import_time.BUDGETS[name]
+    assert ms <= budget, f'"{name}" took {ms:0.1f}ms to import, budget {budget}ms'
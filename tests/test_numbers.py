@@ -0,0 +1,83 @@
+import pytest
+
+from shared.numbers import call_number, canonical_number, clean_number, sip_number
+
+
+@pytest.mark.parametrize('number,expected', [
+    # national
+    ('07700 900123', '+447700900123'),
+    ('07700-900-123', '+447700900123'),
+    ('7700900123', '+447700900123'),
+    ('2125551234', '+442125551234'),
+    # international
+    ('+44 7700 900123', '+447700900123'),
+    ('+44 (0) 7700 900123', '+447700900123'),
+    ('+4407700900123', '+447700900123'),
+    ('+1 (212) 555-1234', '+12125551234'),
+    ('+39 06 1234 5678', '+390612345678'),
+    # "00" prefix
+    ('0044 7700 900123', '+447700900123'),
+    ('001 212 555 1234', '+12125551234'),
+    # extensions
+    ('+44 7700 900123 ext 12', '+447700900123'),
+    ('+44 7700 900123 ext. 12', '+447700900123'),
+    ('07700 900123 x12', '+447700900123'),
+    ('07700900123#12', '+447700900123'),
+    ('+447700900123;ext=12', '+447700900123'),
+    # garbage
+    (None, None),
+    ('', None),
+    ('unknown', None),
+    ('call me 07700 900123', None),
+    ('123', None),
+    ('+44 1234567890123456', None),
+])
+def test_canonical_number(number, expected):
+    assert canonical_number(number) == expected
+
+
+def test_canonical_number_default_country_code():
+    assert canonical_number('06 12 34 56 78', default_country_code='33') == '+33612345678'
+    assert canonical_number('+44 7700 900123', default_country_code='33') == '+447700900123'
+
+
+@pytest.mark.parametrize('number,expected', [
+    ('447700900123', '+447700900123'),
+    ('12125551234', '+12125551234'),
+    ('+447700900123', '+447700900123'),
+    ('07700900123', '+447700900123'),
+    ('00447700900123', '+447700900123'),
+    ('123', None),
+])
+def test_canonical_number_international(number, expected):
+    assert canonical_number(number, international=True) == expected
+
+
+@pytest.mark.parametrize('number,expected', [
+    ('+447700900123', '+447700900123'),
+    ('123', '123'),
+    ('+123', '123'),
+    ('anonymous', 'UNKNOWN'),
+    (None, 'UNKNOWN'),
+])
+def test_call_number(number, expected):
+    assert call_number(number) == expected
+
+
+def test_clean_number():
+    assert clean_number('07700 900123') == '+447700900123'
+    assert clean_number('Ext 123') == '123'
+
+
+@pytest.mark.parametrize('from_header,expected', [
+    ('"+442012345678" <sip:+442012345678@example.com>;tag=abc', '+442012345678'),
+    ('<sip:442012345678@example.com>', '442012345678'),
+    ('<sip:anonymous@example.com>', None),
+])
+def test_sip_number(from_header, expected):
+    assert sip_number(from_header) == expected
+
+
+def test_sip_number_without_plus():
+    number = sip_number('"447700900123" <sip:447700900123@example.com>;tag=abc')
+    assert call_number(number, international=True) == '+447700900123'
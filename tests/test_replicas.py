@@ -0,0 +1,74 @@
+import asyncio
+
+import asyncpg
+
+from app.background import ReplicaMonitor
+from app.settings import Settings
+
+
+class FakePool:
+    def __init__(self, lag=0, error=None):
+        self.lag = lag
+        self.error = error
+
+    async def fetchval(self, sql, *args):
+        if self.error:
+            raise self.error
+        return self.lag
+
+
+def monitor(*replicas):
+    app = {'settings': Settings(), 'pg': FakePool(), 'pg_ro': list(replicas)}
+    return ReplicaMonitor(app, start=False)
+
+
+async def test_up_to_date_replica_used(loop):
+    replica = FakePool(lag=0.5)
+    m = monitor(replica)
+    await m.update()
+    assert m.lags == {replica: 0.5}
+    assert m.pool(1) is replica
+    assert m.pool(0.1) is m.app['pg']
+
+
+async def test_failing_replica_falls_back_to_primary(loop):
+    replica = FakePool(lag=0)
+    m = monitor(replica)
+    await m.update()
+    assert m.pool(10) is replica
+
+    replica.error = asyncpg.InterfaceError('connection is closed')
+    await m.update()
+    assert m.lags == {replica: None}
+    assert m.pool(10) is m.app['pg']
+
+
+async def test_unknown_lag_not_used(loop):
+    replica = FakePool(lag=None)
+    m = monitor(replica)
+    await m.update()
+    assert m.pool(10) is m.app['pg']
+
+
+async def test_slow_replica_times_out(loop, mocker):
+    class SlowPool(FakePool):
+        async def fetchval(self, sql, *args):
+            await asyncio.sleep(1)
+
+    mocker.patch.object(ReplicaMonitor, 'TIMEOUT', 0.01)
+    replica = SlowPool()
+    m = monitor(replica)
+    await m.update()
+    assert m.pool(10) is m.app['pg']
+
+
+async def test_unexpected_error_stops_using_replicas(loop, mocker):
+    replica = FakePool(lag=0)
+    m = monitor(replica)
+    await m.update()
+    assert m.pool(10) is replica
+
+    mocker.patch.object(m, 'check', side_effect=RuntimeError('boom'))
+    await m.update()
+    assert m.lags == {}
+    assert m.pool(10) is m.app['pg']
@@ -0,0 +1,19 @@
+import gzip
+
+from app import utils
+
+
+def test_compress_cached():
+    body = b'{"items": [%s]}' % b','.join(b'123' for _ in range(1000))
+    compressed = utils.compress_cached(body, 'gzip')
+    assert gzip.decompress(compressed) == body
+    # an equal body from another request isn't compressed again
+    assert utils.compress_cached(bytes(bytearray(body)), 'gzip') is compressed
+
+
+def test_compress_cached_size(monkeypatch):
+    monkeypatch.setattr(utils, 'COMPRESSED_CACHE_SIZE', 4)
+    monkeypatch.setattr(utils, '_compressed_cache', {})
+    for i in range(10):
+        utils.compress_cached(str(i).encode() * 1000, 'gzip')
+    assert len(utils._compressed_cache) <= 4